@@ -0,0 +1,320 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .utils import DEFAULT_LIBRARY_ROOT
+
+CHUNK_SIZE = 1024 * 1024
+# Files at least this large are hashed through mmap instead of readinto()
+MMAP_THRESHOLD = 64 * 1024 * 1024
+_HASH_RE = re.compile(r"[0-9a-f]{32,128}")
+_buffers = threading.local()
+FICLONE = 0x40049409
+# Blobs live at <ext>/ab/cd/<hash>.<ext> for a depth of 2; 0 is the flat layout
+SHARD_DEPTH = int(os.environ.get("LIBRARY_SHARD_DEPTH", "2"))
+SHARD_WIDTH = 2
+# Content address digest: "sha256", "blake2b" or "blake2b-tree". Entries
+# without an "algorithm" field were addressed with sha256.
+DIGEST_ALGORITHMS = ("sha256", "blake2b", "blake2b-tree")
+DIGEST_ALGORITHM = os.environ.get("LIBRARY_DIGEST", "sha256")
+# blake2b-tree hashes each segment as a leaf, in parallel for large files
+TREE_SEGMENT_SIZE = 64 * 1024 * 1024
+TREE_WORKERS = os.cpu_count() or 1
+
+
+def _read_buffer() -> memoryview:
+    # One reusable CHUNK_SIZE buffer per thread for readinto()
+    buffer = getattr(_buffers, "view", None)
+    if buffer is None:
+        buffer = _buffers.view = memoryview(bytearray(CHUNK_SIZE))
+    return buffer
+
+
+def _advise_sequential(fd: int) -> None:
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+def _hash_mmap(hasher, fd: int, size: int, throttle) -> None:
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, "madvise"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mm) as view:
+            for offset in range(0, size, CHUNK_SIZE):
+                window = view[offset : offset + CHUNK_SIZE]
+                if throttle is not None:
+                    throttle(len(window))
+                hasher.update(window)
+                window.release()
+
+
+def _tree_node(node_offset: int, node_depth: int, last_node: bool = False):
+    return hashlib.blake2b(
+        digest_size=32,
+        fanout=0,
+        depth=2,
+        leaf_size=TREE_SEGMENT_SIZE,
+        inner_size=32,
+        node_offset=node_offset,
+        node_depth=node_depth,
+        last_node=last_node,
+    )
+
+
+class TreeHasher:
+    """
+    Two-level BLAKE2b tree: every TREE_SEGMENT_SIZE segment is a leaf and the
+    root hashes the concatenated leaf digests. Fed sequentially it gives the
+    same digest as the parallel leaf hashing in compute_hash.
+    The final leaf and the root are flagged last_node, as BLAKE2 tree mode
+    requires. The flag is set when a leaf is started, so without the total
+    `size` each leaf is hashed both ways until the next one begins; pass it
+    when it is known to hash every byte once.
+    """
+
+    def __init__(self, size: int | None = None):
+        self._size = size
+        self._leaves = []
+        self._filled = 0
+        self._total = 0
+        self._start_leaf()
+
+    def _start_leaf(self) -> None:
+        i = len(self._leaves)
+        if self._size is None:
+            self._leaf, self._last = _tree_node(i, 0), _tree_node(i, 0, True)
+        else:
+            last = i >= (self._size - 1) // TREE_SEGMENT_SIZE
+            self._leaf, self._last = _tree_node(i, 0, last), None
+
+    def update(self, data) -> None:
+        view = memoryview(data)
+        while len(view):
+            if self._filled == TREE_SEGMENT_SIZE:
+                # More data, so the full leaf wasn't the last one
+                self._leaves.append(self._leaf.digest())
+                self._start_leaf()
+                self._filled = 0
+            take = min(len(view), TREE_SEGMENT_SIZE - self._filled)
+            self._leaf.update(view[:take])
+            if self._last is not None:
+                self._last.update(view[:take])
+            self._filled += take
+            self._total += take
+            view = view[take:]
+
+    def hexdigest(self) -> str:
+        if self._size is not None and self._total != self._size:
+            raise ValueError(f"Hashed {self._total} bytes, expected {self._size}")
+        last = self._leaf if self._last is None else self._last
+        return _tree_root([*self._leaves, last.digest()])
+
+
+def _tree_root(leaves: list[bytes]) -> str:
+    root = _tree_node(0, 1, True)
+    for leaf in leaves:
+        root.update(leaf)
+    return root.hexdigest()
+
+
+def new_hasher(algorithm: str | None = None, size: int | None = None):
+    # Incremental hasher for a content address algorithm. `size`, the number
+    # of bytes that will be hashed if known, spares blake2b-tree some work.
+    algorithm = algorithm or DIGEST_ALGORITHM
+    if algorithm == "sha256":
+        return hashlib.sha256()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=32)
+    if algorithm == "blake2b-tree":
+        return TreeHasher(size)
+    raise ValueError(f"Unknown digest algorithm: {algorithm}")
+
+
+def entry_algorithm(entry: dict[str, object]) -> str:
+    return entry.get("algorithm", "sha256")
+
+
+def _hash_tree_parallel(fd: int, size: int, throttle) -> str:
+    # Hash each segment on its own thread; hashlib releases the GIL.
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+
+        def leaf(i: int) -> bytes:
+            hasher = _tree_node(i, 0, i == count - 1)
+            end = min(size, (i + 1) * TREE_SEGMENT_SIZE)
+            for offset in range(i * TREE_SEGMENT_SIZE, end, CHUNK_SIZE):
+                window = view[offset : min(end, offset + CHUNK_SIZE)]
+                if throttle is not None:
+                    throttle(len(window))
+                hasher.update(window)
+                window.release()
+            return hasher.digest()
+
+        count = -(-size // TREE_SEGMENT_SIZE)
+        with ThreadPoolExecutor(max_workers=min(TREE_WORKERS, count)) as pool:
+            leaves = list(pool.map(leaf, range(count)))
+    return _tree_root(leaves)
+
+
+def compute_hash(path: Path | str, throttle=None, algorithm: str | None = None) -> str:
+    """
+    Content address of a file (DIGEST_ALGORITHM unless given), computed
+    without allocating per chunk: large files are hashed straight from an
+    mmap, smaller ones through readinto() on a reusable buffer. blake2b-tree
+    hashes the segments of files above TREE_SEGMENT_SIZE on several threads.
+    `throttle` is called with the size of every chunk, e.g. a RateLimiter.
+    """
+    path = Path(path)  # ensure Path object
+    with path.open("rb", buffering=0) as f:
+        return hash_file(f, throttle, algorithm)
+
+
+def hash_file(f, throttle=None, algorithm: str | None = None) -> str:
+    # compute_hash for a file that is already open (unbuffered, at offset 0)
+    algorithm = algorithm or DIGEST_ALGORITHM
+    fd = f.fileno()
+    size = os.fstat(fd).st_size
+    hasher = new_hasher(algorithm, size)
+    _advise_sequential(fd)
+    if algorithm == "blake2b-tree" and size > TREE_SEGMENT_SIZE:
+        return _hash_tree_parallel(fd, size, throttle)
+    if size >= MMAP_THRESHOLD:
+        _hash_mmap(hasher, fd, size, throttle)
+        return hasher.hexdigest()
+
+    buffer = _read_buffer()
+    while n := f.readinto(buffer):
+        if throttle is not None:
+            throttle(n)
+        hasher.update(buffer[:n])
+    return hasher.hexdigest()
+
+
+def iter_blobs(root: str | Path | None = None):
+    """
+    Lists the blob store with os.scandir and yields (hash, ext, path) for
+    every <hash>.<ext> file under the format directories, in any shard layout.
+    """
+    root = Path(root or DEFAULT_LIBRARY_ROOT)
+    try:
+        formats = [e for e in os.scandir(root) if e.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return
+    for fmt in formats:
+        stack = [fmt.path]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    file_hash, dot, ext = entry.name.partition(".")
+                    if dot and ext == fmt.name and _HASH_RE.fullmatch(file_hash):
+                        yield file_hash, ext, entry.path
+
+
+def blob_path(
+    file_hash: str,
+    ext: str,
+    shard_depth: int | None = None,
+    root: str | Path | None = None,
+) -> Path:
+    # Location of a blob in the content-addressed store.
+    if shard_depth is None:
+        shard_depth = SHARD_DEPTH
+    shards = [
+        file_hash[i * SHARD_WIDTH : (i + 1) * SHARD_WIDTH] for i in range(shard_depth)
+    ]
+    return Path(root or DEFAULT_LIBRARY_ROOT).joinpath(
+        ext, *shards, f"{file_hash}.{ext}"
+    )
+
+
+def _reflink(src: Path, dest: Path) -> None:
+    # Share the source's extents (btrfs, XFS, ...); fails across filesystems.
+    with src.open("rb") as f, dest.open("wb") as out:
+        fcntl.ioctl(out.fileno(), FICLONE, f.fileno())
+
+
+def _hardlink(src: Path, dest: Path) -> None:
+    # The blob shares the source's inode, so editing the source edits the blob.
+    dest.unlink()
+    os.link(src, dest)
+
+
+def _copy_range(src: Path, dest: Path) -> None:
+    # In-kernel copy; copy_file_range may be offloaded by NFS/SMB servers.
+    copy = getattr(os, "copy_file_range", None) or os.sendfile
+    with src.open("rb") as f, dest.open("wb") as out:
+        remaining = os.fstat(f.fileno()).st_size
+        while remaining > 0:
+            if copy is os.sendfile:
+                copied = copy(out.fileno(), f.fileno(), None, remaining)
+            else:
+                copied = copy(f.fileno(), out.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+
+def _plain_copy(src: Path, dest: Path) -> None:
+    shutil.copyfile(src, dest)
+
+
+_PLACERS = {
+    "reflink": _reflink,
+    "hardlink": _hardlink,
+    "copy_file_range": _copy_range,
+    "copy": _plain_copy,
+}
+
+
+def place_blob(src: Path, dest_path: Path, mode: str = "copy") -> str:
+    """
+    Puts a file at dest_path using the given storage mode and returns the mode
+    that succeeded. "auto" tries reflink, hardlink, copy_file_range and copy
+    in that order; any other mode is used as-is and raises OSError on failure.
+    The blob is written to a temp file and renamed into place.
+    """
+    if mode == "auto":
+        modes = ("reflink", "hardlink", "copy_file_range", "copy")
+    elif mode in _PLACERS:
+        modes = (mode,)
+    else:
+        raise ValueError(f"Unknown storage mode: {mode}")
+
+    for i, candidate in enumerate(modes):
+        fd, tmp_name = tempfile.mkstemp(
+            dir=dest_path.parent, prefix=".ingest-", suffix=".part"
+        )
+        os.close(fd)
+        tmp_path = Path(tmp_name)
+        try:
+            _PLACERS[candidate](src, tmp_path)
+            if candidate != "hardlink":
+                shutil.copystat(src, tmp_path)
+            os.replace(tmp_path, dest_path)
+            return candidate
+        except OSError:
+            tmp_path.unlink(missing_ok=True)
+            if i == len(modes) - 1:
+                raise
+
+
+def _prune_shards(directory: Path, stop: Path) -> None:
+    # Remove shard directories left empty, up to (not including) stop.
+    while directory != stop and stop in directory.parents:
+        try:
+            directory.rmdir()
+        except OSError:
+            return
+        directory = directory.parent
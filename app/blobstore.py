@@ -0,0 +1,1491 @@
+import bisect
+import collections
+import contextlib
+import hashlib
+import io
+import mmap
+import os
+import re
+import shutil
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from pathlib import Path
+from typing import BinaryIO
+
+from .addressing import (
+    CHUNK_SIZE,
+    _advise_sequential,
+    _prune_shards,
+    _read_buffer,
+    blob_path,
+    compute_hash,
+    hash_file,
+    iter_blobs,
+    new_hasher,
+    place_blob,
+)
+from .utils import DEFAULT_LIBRARY_ROOT, load_index, save_index
+
+# Where new blobs go: "files" (one file per blob), "pack" (small blobs
+# appended to pack files, larger ones as files), "chunks" (deduplicated
+# content-defined chunks) or "disks" (files spread over several disks)
+BLOB_STORE = os.environ.get("LIBRARY_BLOB_STORE", "files")
+PACK_DIR = DEFAULT_LIBRARY_ROOT / "packs"
+# Blobs up to this size are packed; larger ones stay loose files
+PACK_MAX_BLOB = int(os.environ.get("LIBRARY_PACK_MAX_BLOB", 4 * 1024 * 1024))
+# A pack is sealed, and gets its .idx, once it grows past this size
+PACK_SIZE = int(os.environ.get("LIBRARY_PACK_SIZE", 1024 * 1024 * 1024))
+# Record header in a pack: magic, digest, data length, format
+_RECORD = struct.Struct("<4s32sQ8s")
+_RECORD_MAGIC = b"BLB1"
+# .idx entry: digest, data offset, data length, format; sorted by digest
+_IDX_ENTRY = struct.Struct("<32sQQ8s")
+CHUNK_DIR = DEFAULT_LIBRARY_ROOT / "chunks"
+# Content-defined chunk sizes: past CHUNK_MIN, a chunk ends where a hash of
+# the CHUNK_WINDOW bytes before has its low bits clear, on average after
+# CHUNK_AVG bytes; zip members always start a new chunk
+CHUNK_MIN = 8 * 1024
+CHUNK_AVG = 16 * 1024
+CHUNK_MAX = 64 * 1024
+CHUNK_WINDOW = 32
+# The window hash is built by doubling: a byte table, then one table per step
+_WINDOW_TABLES = [
+    bytes(
+        sorted(
+            range(256),
+            key=lambda v: hashlib.blake2b(bytes([v]), key=bytes([step])).digest(),
+        )
+    )
+    for step in range(CHUNK_WINDOW.bit_length())
+]
+# Of the positions whose window hash byte is zero (1 in 256), those whose
+# window also passes this blake2b mask may end a chunk
+_CUT_MASK = (CHUNK_AVG - CHUNK_MIN) // 256 - 1
+_ZERO_BYTE = re.compile(b"\0")
+# Disks for the "disks" store, separated by os.pathsep; blobs are placed on
+# them by consistent hashing and kept on LIBRARY_REPLICAS of them
+DISK_ROOTS = [
+    Path(root) for root in os.environ.get("LIBRARY_DISKS", "").split(os.pathsep) if root
+]
+REPLICAS = int(os.environ.get("LIBRARY_REPLICAS", "1"))
+# Points per disk on the hash ring; more points even out the spread
+RING_POINTS = 128
+# Recipe of a chunked blob: total size, then the digest of every chunk
+_RECIPE = struct.Struct("<Q")
+_PACK_RE = re.compile(r"pack-(\d{8})\.pack")
+_SCHEME_RE = re.compile(r"([a-z]+):(.+)")
+
+
+@contextlib.contextmanager
+def _open_source(src: Path | BinaryIO):
+    # Opens a source path; an already open binary file is used as it is
+    if hasattr(src, "read"):
+        yield src
+    else:
+        with Path(src).open("rb", buffering=0) as f:
+            yield f
+
+
+def _source_fd(f) -> int | None:
+    # The descriptor behind a source; None for in-memory or archive streams
+    try:
+        return f.fileno()
+    except (AttributeError, OSError):
+        return None
+
+
+def _remaining_size(f) -> int | None:
+    # Bytes left to read from a regular file or in-memory source, else None.
+    # Streams that know their length, such as archive members, say so in
+    # a `remaining` attribute.
+    fd = _source_fd(f)
+    if fd is not None:
+        st = os.fstat(fd)
+        return st.st_size - f.tell() if stat.S_ISREG(st.st_mode) else None
+    if isinstance(f, io.BytesIO):
+        return f.getbuffer().nbytes - f.tell()
+    return getattr(f, "remaining", None)
+
+
+def _source_size(f) -> int | None:
+    # Size of a source if it can be found without reading it
+    fd = _source_fd(f)
+    if fd is not None:
+        return os.fstat(fd).st_size
+    if isinstance(f, io.BytesIO):
+        return f.getbuffer().nbytes
+    return None
+
+
+class FileBlobStore:
+    """
+    Every blob is its own file at blob_path(hash, ext) under `root`, and its
+    stored_path is that file's path. Other stores extend this one and
+    address their blobs as "<scheme>:<hash>.<ext>".
+    """
+
+    scheme = None
+    root = DEFAULT_LIBRARY_ROOT
+
+    def __init__(self, root: str | Path | None = None):
+        if root is not None:
+            self.root = Path(root)
+
+    def _parse(self, stored_path: str) -> tuple[str, str] | None:
+        # (hash, ext) of a blob addressed by this store's scheme, else None
+        match = _SCHEME_RE.fullmatch(str(stored_path))
+        if self.scheme is None or match is None or match.group(1) != self.scheme:
+            return None
+        file_hash, _, ext = match.group(2).partition(".")
+        return file_hash, ext
+
+    def _address(self, file_hash: str, ext: str) -> str:
+        return f"{self.scheme}:{file_hash}.{ext}"
+
+    def put(
+        self, src: Path, file_hash: str, ext: str, mode: str = "copy"
+    ) -> tuple[str, str | None]:
+        """
+        Stores a file under a known hash unless that blob already exists.
+        Returns the stored_path and the storage mode used (None if it existed).
+        """
+        dest_path = blob_path(file_hash, ext, root=self.root)
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+
+        if dest_path.exists():
+            return str(dest_path), None
+        return str(dest_path), place_blob(src, dest_path, mode)
+
+    def put_stream(
+        self,
+        src: Path | BinaryIO,
+        ext: str,
+        algorithm: str | None = None,
+        file_hash: str | None = None,
+    ) -> tuple[str, str, str]:
+        """
+        Copies a file (a path or an open binary file) into the store while
+        hashing it, reading the source once; a `file_hash` already known is
+        trusted instead. Blobs from streams without a file descriptor get mode
+        0644 and the current time.
+        The copy goes to a temp file in the format directory and is renamed to
+        its blob path, or discarded if that blob already exists.
+        Returns the hash, the stored_path and the storage mode.
+        """
+        dest_dir = self.root / ext
+        dest_dir.mkdir(parents=True, exist_ok=True)
+
+        hasher = None
+        fd, tmp_name = tempfile.mkstemp(dir=dest_dir, prefix=".ingest-", suffix=".part")
+        tmp_path = Path(tmp_name)
+        try:
+            with _open_source(src) as f, os.fdopen(fd, "wb") as out:
+                src_fd = _source_fd(f)
+                if src_fd is not None:
+                    _advise_sequential(src_fd)
+                if file_hash is None:
+                    hasher = new_hasher(algorithm, _remaining_size(f))
+                buffer = _read_buffer()
+                while n := f.readinto(buffer):
+                    if hasher is not None:
+                        hasher.update(buffer[:n])
+                    out.write(buffer[:n])
+            if src_fd is not None:
+                st = os.fstat(src_fd)
+                os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+                os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            else:
+                os.chmod(tmp_path, 0o644)
+
+            if hasher is not None:
+                file_hash = hasher.hexdigest()
+            dest_path = blob_path(file_hash, ext, root=self.root)
+            if dest_path.exists():
+                tmp_path.unlink()
+            else:
+                dest_path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp_path, dest_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        return file_hash, str(dest_path), "stream"
+
+    def copy(self, stored_path: str, file_hash: str, ext: str) -> str:
+        # Store an existing blob under another hash, hard-linking if possible.
+        new_path = blob_path(file_hash, ext, root=self.root)
+        if not new_path.exists():
+            new_path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(stored_path, new_path)
+            except OSError:
+                shutil.copy2(stored_path, new_path)
+        return str(new_path)
+
+    def exists(self, stored_path: str) -> bool:
+        return os.path.exists(stored_path)
+
+    def size(self, stored_path: str) -> int:
+        return os.stat(stored_path).st_size
+
+    def open(self, stored_path: str):
+        return open(stored_path, "rb")
+
+    def hash(
+        self, stored_path: str, throttle=None, algorithm: str | None = None
+    ) -> str:
+        return compute_hash(stored_path, throttle, algorithm)
+
+    def delete(self, stored_path: str) -> None:
+        path = Path(stored_path)
+        path.unlink(missing_ok=True)
+        _prune_shards(path.parent, self.root / path.suffix.lstrip("."))
+
+    def iter_blobs(self):
+        # Yields (hash, ext, stored_path) for every blob in the store.
+        yield from iter_blobs(self.root)
+
+
+class PackBlobStore(FileBlobStore):
+    """
+    Git-style pack store. Blobs up to PACK_MAX_BLOB are appended to
+    PACK_DIR/pack-<n>.pack and addressed as "pack:<hash>.<ext>"; larger
+    blobs are stored as loose files, as in FileBlobStore.
+
+    A pack is sealed once it passes PACK_SIZE and gets an .idx of fixed-width
+    entries sorted by digest, which is binary-searched through mmap. Packs
+    without an .idx are indexed in memory from their record headers. Appends
+    hold an exclusive flock on the pack, so several processes can write at
+    once. A crash mid-append leaves a torn record, which the next append
+    truncates.
+
+    Deleting a packed blob only tombstones it; repack() reclaims the space.
+    """
+
+    scheme = "pack"
+
+    def __init__(self, pack_dir: str | Path = PACK_DIR):
+        self.pack_dir = Path(pack_dir)
+        self.deleted_path = self.pack_dir / "deleted"
+        self._lock = threading.RLock()
+        self._sealed = {}
+        self._unsealed = {}
+        self._scanned = {}
+        self._fds = {}
+        self._dir_mtime = None
+        self._deleted = set()
+        self._deleted_mtime = None
+
+    @staticmethod
+    def _packable(file_hash: str | None, ext: str, size: int) -> bool:
+        return (
+            size <= PACK_MAX_BLOB
+            and len(ext.encode()) <= 8
+            and (file_hash is None or len(file_hash) == 64)
+        )
+
+    def _pack_path(self, number: int, suffix: str = ".pack") -> Path:
+        return self.pack_dir / f"pack-{number:08d}{suffix}"
+
+    def _fd(self, number: int) -> int:
+        fd = self._fds.get(number)
+        if fd is None:
+            fd = self._fds[number] = os.open(self._pack_path(number), os.O_RDONLY)
+        return fd
+
+    def _load_deleted(self) -> None:
+        try:
+            mtime = self.deleted_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self._deleted, self._deleted_mtime = set(), None
+            return
+        if mtime != self._deleted_mtime:
+            with self.deleted_path.open("r", encoding="utf-8") as f:
+                self._deleted = {line.strip() for line in f if line.strip()}
+            self._deleted_mtime = mtime
+
+    def _scan(self, number: int) -> None:
+        # Index the records appended to an unsealed pack since the last scan.
+        records = self._unsealed.setdefault(number, {})
+        offset = self._scanned.get(number, 0)
+        fd = self._fd(number)
+        end = os.fstat(fd).st_size
+        while offset + _RECORD.size <= end:
+            header = os.pread(fd, _RECORD.size, offset)
+            magic, digest, length, ext = _RECORD.unpack(header)
+            data_offset = offset + _RECORD.size
+            if magic != _RECORD_MAGIC or data_offset + length > end:
+                break  # torn or still being written
+            records.setdefault(digest, (data_offset, length, ext))
+            offset = data_offset + length
+        self._scanned[number] = offset
+
+    def _refresh(self) -> None:
+        # Pick up packs, seals and appends from other writers.
+        self._load_deleted()
+        try:
+            mtime = self.pack_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._dir_mtime:
+            self._dir_mtime = mtime
+            numbers = sorted(
+                int(m.group(1))
+                for m in map(_PACK_RE.fullmatch, os.listdir(self.pack_dir))
+                if m
+            )
+            for number in numbers:
+                if number in self._sealed:
+                    continue
+                idx_path = self._pack_path(number, ".idx")
+                if idx_path.exists():
+                    self._unsealed.pop(number, None)
+                    self._scanned.pop(number, None)
+                    with idx_path.open("rb") as f:
+                        size = os.fstat(f.fileno()).st_size
+                        self._sealed[number] = (
+                            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                            if size
+                            else b""
+                        )
+                else:
+                    self._unsealed.setdefault(number, {})
+            for number in list(self._sealed):
+                if number not in numbers:
+                    self._forget(number)
+            for number in list(self._unsealed):
+                if number not in numbers:
+                    self._forget(number)
+        for number in self._unsealed:
+            self._scan(number)
+
+    def _forget(self, number: int) -> None:
+        # Drop a pack removed by repack()
+        self._sealed.pop(number, None)
+        self._unsealed.pop(number, None)
+        self._scanned.pop(number, None)
+        fd = self._fds.pop(number, None)
+        if fd is not None:
+            os.close(fd)
+
+    @staticmethod
+    def _search_idx(idx, digest: bytes) -> tuple[int, int, bytes] | None:
+        lo, hi = 0, len(idx) // _IDX_ENTRY.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mid * _IDX_ENTRY.size
+            if idx[start : start + 32] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo * _IDX_ENTRY.size
+        if idx[start : start + 32] == digest:
+            return _IDX_ENTRY.unpack_from(idx, start)[1:]
+        return None
+
+    def _lookup(self, digest: bytes) -> tuple[int, int, int, bytes] | None:
+        for number, records in self._unsealed.items():
+            if digest in records:
+                return (number, *records[digest])
+        for number, idx in self._sealed.items():
+            found = self._search_idx(idx, digest)
+            if found is not None:
+                return (number, *found)
+        return None
+
+    def _find(
+        self, file_hash: str, include_deleted: bool = False
+    ) -> tuple[int, int, int, bytes] | None:
+        # (pack, offset, length, ext) of a packed blob
+        with self._lock:
+            digest = bytes.fromhex(file_hash)
+            found = self._lookup(digest)
+            if found is None:
+                self._refresh()
+                found = self._lookup(digest)
+            if found is not None and not include_deleted:
+                self._load_deleted()
+                if file_hash in self._deleted:
+                    return None
+            return found
+
+    def _locate(self, stored_path: str) -> tuple[int, int, int, bytes]:
+        file_hash, _ext = self._parse(stored_path)
+        found = self._find(file_hash)
+        if found is None:
+            raise FileNotFoundError(stored_path)
+        return found
+
+    def _undelete(self, file_hash: str) -> None:
+        # A tombstoned blob stored again is revived; its data is still packed
+        self._deleted.discard(file_hash)
+        tmp_path = self.deleted_path.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            f.writelines(f"{h}\n" for h in sorted(self._deleted))
+        os.replace(tmp_path, self.deleted_path)
+        self._deleted_mtime = self.deleted_path.stat().st_mtime_ns
+
+    def _open_for_append(self) -> tuple[int, int]:
+        # Lock the newest unsealed pack (creating one if needed).
+        import fcntl
+
+        self.pack_dir.mkdir(parents=True, exist_ok=True)
+        while True:
+            self._refresh()
+            number = max([*self._sealed, *self._unsealed], default=0)
+            if number == 0 or number in self._sealed:
+                number += 1
+            fd = os.open(self._pack_path(number), os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if not self._pack_path(number, ".idx").exists():
+                self._unsealed.setdefault(number, {})
+                self._scan(number)
+                return number, fd
+            # Sealed by another writer while we waited for the lock
+            os.close(fd)
+
+    def _append(
+        self,
+        f,
+        ext: str,
+        file_hash: str | None = None,
+        algorithm: str | None = None,
+    ) -> str:
+        """
+        Appends the contents of a binary file object as one record, hashing
+        it on the way unless file_hash is given. The record is dropped again
+        if that blob turns out to be packed already.
+        Returns the blob's hash.
+        """
+        with self._lock:
+            if file_hash is not None and self._find(file_hash, True) is not None:
+                if file_hash in self._deleted:
+                    self._undelete(file_hash)
+                return file_hash
+
+            number, fd = self._open_for_append()
+            try:
+                start = self._scanned[number]
+                # Anything past the last complete record was torn by a crash
+                os.ftruncate(fd, start)
+                offset = start + _RECORD.size
+                os.pwrite(fd, bytes(_RECORD.size), start)
+                hasher = None
+                if file_hash is None:
+                    hasher = new_hasher(algorithm, _remaining_size(f))
+                buffer = _read_buffer()
+                while n := f.readinto(buffer):
+                    if hasher is not None:
+                        hasher.update(buffer[:n])
+                    written = 0
+                    while written < n:
+                        written += os.pwrite(fd, buffer[written:n], offset + written)
+                    offset += n
+
+                file_hash = file_hash or hasher.hexdigest()
+                digest = bytes.fromhex(file_hash)
+                if self._lookup(digest) is not None:
+                    os.ftruncate(fd, start)
+                    if file_hash in self._deleted:
+                        self._undelete(file_hash)
+                    return file_hash
+
+                length = offset - start - _RECORD.size
+                header = _RECORD.pack(_RECORD_MAGIC, digest, length, ext.encode())
+                os.pwrite(fd, header, start)
+                self._unsealed[number][digest] = (
+                    start + _RECORD.size,
+                    length,
+                    ext.encode(),
+                )
+                self._scanned[number] = offset
+                if offset >= PACK_SIZE:
+                    self._seal(number)
+            finally:
+                os.close(fd)
+            return file_hash
+
+    def _append_all(self, records) -> None:
+        """
+        Appends (data, ext, file_hash) records, such as the chunks of a blob,
+        holding the pack lock across all of them instead of taking it per
+        record. Records already packed are skipped.
+        """
+        with self._lock:
+            self._refresh()
+            number = fd = None
+            try:
+                for data, ext, file_hash in records:
+                    digest = bytes.fromhex(file_hash)
+                    if fd is None and self._lookup(digest) is None:
+                        number, fd = self._open_for_append()
+                        offset = self._scanned[number]
+                        # Anything past the last complete record was torn
+                        os.ftruncate(fd, offset)
+                    if self._lookup(digest) is not None:
+                        if file_hash in self._deleted:
+                            self._undelete(file_hash)
+                        continue
+
+                    # Data first, header last: a crash leaves a torn record
+                    header = _RECORD.pack(
+                        _RECORD_MAGIC, digest, len(data), ext.encode()
+                    )
+                    view = memoryview(bytes(_RECORD.size) + data)
+                    written = 0
+                    while written < len(view):
+                        written += os.pwrite(fd, view[written:], offset + written)
+                    os.pwrite(fd, header, offset)
+                    self._unsealed[number][digest] = (
+                        offset + _RECORD.size,
+                        len(data),
+                        ext.encode(),
+                    )
+                    offset += len(view)
+                    self._scanned[number] = offset
+                    if offset >= PACK_SIZE:
+                        self._seal(number)
+                        os.close(fd)
+                        fd = None
+            finally:
+                if fd is not None:
+                    os.close(fd)
+
+    def _seal(self, number: int) -> None:
+        # Write the pack's .idx; from then on the pack is read-only.
+        self._write_idx(number, self._unsealed[number])
+
+    def _write_idx(self, number: int, records: dict) -> None:
+        entries = sorted(records.items())
+        tmp_path = self._pack_path(number, ".idx.tmp")
+        with tmp_path.open("wb") as f:
+            for digest, (offset, length, ext) in entries:
+                f.write(_IDX_ENTRY.pack(digest, offset, length, ext))
+        os.replace(tmp_path, self._pack_path(number, ".idx"))
+
+    def put(
+        self, src: Path, file_hash: str, ext: str, mode: str = "copy"
+    ) -> tuple[str, str | None]:
+        size = src.stat().st_size
+        if not self._packable(file_hash, ext, size):
+            return super().put(src, file_hash, ext, mode)
+        existed = self._find(file_hash) is not None
+        with src.open("rb", buffering=0) as f:
+            self._append(f, ext, file_hash)
+        return self._address(file_hash, ext), None if existed else "pack"
+
+    def put_stream(
+        self, src: Path | BinaryIO, ext: str, algorithm: str | None = None
+    ) -> tuple[str, str, str]:
+        with _open_source(src) as f:
+            size = _source_size(f)
+            if size is None or not self._packable(None, ext, size):
+                return super().put_stream(f, ext, algorithm)
+            file_hash = self._append(f, ext, algorithm=algorithm)
+        return file_hash, self._address(file_hash, ext), "pack"
+
+    def copy(self, stored_path: str, file_hash: str, ext: str) -> str:
+        if self._parse(stored_path) is None:
+            return super().copy(stored_path, file_hash, ext)
+        with self.open(stored_path) as f:
+            self._append(f, ext, file_hash)
+        return self._address(file_hash, ext)
+
+    def exists(self, stored_path: str) -> bool:
+        parsed = self._parse(stored_path)
+        if parsed is None:
+            return super().exists(stored_path)
+        return self._find(parsed[0]) is not None
+
+    def size(self, stored_path: str) -> int:
+        if self._parse(stored_path) is None:
+            return super().size(stored_path)
+        return self._locate(stored_path)[2]
+
+    def open(self, stored_path: str):
+        if self._parse(stored_path) is None:
+            return super().open(stored_path)
+        number, offset, length, _ext = self._locate(stored_path)
+        return io.BytesIO(os.pread(self._fd(number), length, offset))
+
+    def hash(
+        self, stored_path: str, throttle=None, algorithm: str | None = None
+    ) -> str:
+        if self._parse(stored_path) is None:
+            return super().hash(stored_path, throttle, algorithm)
+        number, offset, length, _ext = self._locate(stored_path)
+        fd = self._fd(number)
+        hasher = new_hasher(algorithm, length)
+        buffer = _read_buffer()
+        end = offset + length
+        while offset < end:
+            n = os.preadv(fd, [buffer[: min(CHUNK_SIZE, end - offset)]], offset)
+            if n == 0:
+                raise FileNotFoundError(stored_path)  # pack truncated
+            if throttle is not None:
+                throttle(n)
+            hasher.update(buffer[:n])
+            offset += n
+        return hasher.hexdigest()
+
+    def delete(self, stored_path: str) -> None:
+        parsed = self._parse(stored_path)
+        if parsed is None:
+            return super().delete(stored_path)
+        with self._lock:
+            if self._find(parsed[0]) is None:
+                return
+            with self.deleted_path.open("a", encoding="utf-8") as f:
+                f.write(f"{parsed[0]}\n")
+            self._deleted.add(parsed[0])
+            self._deleted_mtime = self.deleted_path.stat().st_mtime_ns
+
+    def _records(self):
+        # Yields (hash, ext, pack, offset, length) for every live packed blob.
+        with self._lock:
+            self._refresh()
+            packs = [
+                (n, list(records.items())) for n, records in self._unsealed.items()
+            ]
+            packs += [
+                (n, ((d, (o, l, e)) for d, o, l, e in _IDX_ENTRY.iter_unpack(idx)))
+                for n, idx in self._sealed.items()
+            ]
+            deleted = set(self._deleted)
+        for number, records in packs:
+            for digest, (offset, length, ext) in records:
+                file_hash = digest.hex()
+                if file_hash not in deleted:
+                    ext = ext.rstrip(b"\0").decode()
+                    yield file_hash, ext, number, offset, length
+
+    def iter_packed(self):
+        # Yields (hash, ext, stored_path) for every live packed blob.
+        for file_hash, ext, *_location in self._records():
+            yield file_hash, ext, self._address(file_hash, ext)
+
+    def iter_blobs(self):
+        yield from super().iter_blobs()
+        yield from self.iter_packed()
+
+    def repack(self) -> int:
+        """
+        Rewrites all packs without their tombstoned blobs and removes the old
+        packs. Don't run it while another process writes to the store.
+        Returns the number of bytes reclaimed.
+        """
+        with self._lock:
+            self._refresh()
+            old = sorted([*self._sealed, *self._unsealed])
+            if not old:
+                return 0
+            before = sum(self._pack_path(n).stat().st_size for n in old)
+
+            number = old[-1] + 1
+            out = None
+            seen = set()
+            for file_hash, ext, pack, offset, length in list(self._records()):
+                if file_hash in seen:
+                    continue
+                seen.add(file_hash)
+                if out is None:
+                    out = self._pack_path(number).open("wb")
+                    records = {}
+                digest = bytes.fromhex(file_hash)
+                records[digest] = (out.tell() + _RECORD.size, length, ext.encode())
+                out.write(_RECORD.pack(_RECORD_MAGIC, digest, length, ext.encode()))
+                out.write(os.pread(self._fd(pack), length, offset))
+                if out.tell() >= PACK_SIZE:
+                    out.close()
+                    self._write_idx(number, records)
+                    number += 1
+                    out = None
+            after = out.tell() if out is not None else 0
+            if out is not None:
+                out.close()
+            after += sum(
+                self._pack_path(n).stat().st_size for n in range(old[-1] + 1, number)
+            )
+
+            for number in old:
+                self._forget(number)
+                self._pack_path(number, ".idx").unlink(missing_ok=True)
+                self._pack_path(number).unlink(missing_ok=True)
+            self.deleted_path.unlink(missing_ok=True)
+            self._deleted, self._deleted_mtime = set(), None
+            self._dir_mtime = None
+            return before - after
+
+
+def _zip_cuts(f) -> list[int]:
+    # Offsets of the members and central directory of a zip (EPUB, CBZ, ...)
+    cuts = []
+    if not f.seekable():
+        return cuts
+    if f.read(4) == b"PK\x03\x04":
+        try:
+            with zipfile.ZipFile(f) as zf:
+                cuts = [info.header_offset for info in zf.infolist()]
+                cuts.append(zf.start_dir)
+        except zipfile.BadZipFile:
+            pass
+    f.seek(0)
+    return sorted(cuts)
+
+
+def _first_cut(data: bytes, lo: int, hi: int) -> int | None:
+    """
+    The first offset i in lo..hi (lo >= CHUNK_WINDOW) after which a chunk of
+    `data` may end, judged from the window data[i - CHUNK_WINDOW:i], or None.
+    The window hash of every position is computed at once with bytes.translate
+    and big-integer shifts, doubling the window each step, so the bytes are
+    never looped over in Python; only the 1 in 256 positions whose hash is
+    zero are checked one by one.
+    """
+    block = data[lo - CHUNK_WINDOW : hi]
+    n = len(block)
+    hashes = block.translate(_WINDOW_TABLES[0])
+    span = 1
+    for table in _WINDOW_TABLES[1:]:
+        # Combine each position with the window `span` bytes before it
+        earlier = int.from_bytes(hashes.translate(table), "little") << (8 * span)
+        hashes = (int.from_bytes(hashes, "little") ^ earlier).to_bytes(
+            n + span, "little"
+        )[:n]
+        span *= 2
+    for match in _ZERO_BYTE.finditer(hashes, CHUNK_WINDOW - 1):
+        i = lo - CHUNK_WINDOW + match.start() + 1
+        window = hashlib.blake2b(data[i - CHUNK_WINDOW : i], digest_size=8)
+        if not int.from_bytes(window.digest(), "little") & _CUT_MASK:
+            return i
+    return None
+
+
+def iter_chunks(f, cuts: list[int] = ()):
+    """
+    Splits a binary file object into content-defined chunks and yields each
+    as bytes. `cuts` are offsets that always start a new chunk, such as the
+    zip members of an EPUB, so an edited member doesn't shift its neighbours'
+    chunk boundaries. Within a member, boundaries depend only on the bytes
+    just before them, so an insertion changes the chunks around it and no
+    others.
+    """
+    cuts = collections.deque(cuts)
+    data = b""
+    start = 0  # where in data the next chunk starts
+    offset = 0  # file offset of data[start]
+    eof = False
+    while True:
+        while cuts and cuts[0] <= offset:
+            cuts.popleft()
+        limit = min(CHUNK_MAX, cuts[0] - offset) if cuts else CHUNK_MAX
+        while not eof and len(data) - start < limit:
+            more = f.read(max(CHUNK_SIZE, limit))
+            if more:
+                data = data[start:] + more
+                start = 0
+            else:
+                eof = True
+        end = start + min(limit, len(data) - start)
+        if end == start:
+            return
+
+        # Cut points can't fall in the first CHUNK_MIN bytes, so those are
+        # not hashed; the rest is hashed a stretch at a time
+        cut = None
+        lo = start + CHUNK_MIN
+        while cut is None and lo <= end:
+            hi = min(end, lo + CHUNK_AVG - CHUNK_MIN)
+            cut = _first_cut(data, lo, hi)
+            lo = hi + 1
+        cut = cut or end
+        yield data[start:cut]
+        offset += cut - start
+        start = cut
+
+
+class ChunkBlobStore(FileBlobStore):
+    """
+    Deduplicating store for near-identical files, such as editions of a book
+    that differ in a few XHTML files. Blobs are split with content-defined
+    chunking (cut at every zip member as well) and each unique chunk is
+    packed once under CHUNK_DIR/data, all of a blob's chunks under one lock
+    of the pack.
+    A blob is addressed as "chunks:<hash>.<ext>" and kept as a recipe (its
+    size and chunk digests) in CHUNK_DIR/recipes; reads fetch its chunks
+    from the packs as they are reached.
+
+    Zip members are chunked as stored, not decompressed, so that every blob
+    reassembles byte for byte to its content address.
+
+    Deleting a blob tombstones its recipe; repack() also drops chunks that no
+    live recipe refers to.
+    """
+
+    scheme = "chunks"
+
+    def __init__(self, chunk_dir: str | Path = CHUNK_DIR):
+        self.chunk_dir = Path(chunk_dir)
+        self.chunks = PackBlobStore(self.chunk_dir / "data")
+        self.recipes = PackBlobStore(self.chunk_dir / "recipes")
+
+    @staticmethod
+    def _chunkable(file_hash: str | None, ext: str) -> bool:
+        return len(ext.encode()) <= 8 and (file_hash is None or len(file_hash) == 64)
+
+    def _store_chunks(
+        self,
+        f,
+        ext: str,
+        file_hash: str | None = None,
+        algorithm: str | None = None,
+    ) -> str:
+        # Pack the chunks of a file, then its recipe. Returns the file's hash.
+        hasher = None
+        if file_hash is None:
+            hasher = new_hasher(algorithm, _remaining_size(f))
+        digests = []
+        total = 0
+
+        def chunk_records():
+            nonlocal total
+            for chunk in iter_chunks(f, _zip_cuts(f)):
+                if hasher is not None:
+                    hasher.update(chunk)
+                digest = hashlib.blake2b(chunk, digest_size=32).digest()
+                digests.append(digest)
+                total += len(chunk)
+                yield chunk, "chunk", digest.hex()
+
+        self.chunks._append_all(chunk_records())
+        file_hash = file_hash or hasher.hexdigest()
+        recipe = _RECIPE.pack(total) + b"".join(digests)
+        self.recipes._append(io.BytesIO(recipe), ext, file_hash)
+        return file_hash
+
+    def _recipe(self, stored_path: str) -> tuple[int, list[bytes]]:
+        # Size and chunk digests of a chunked blob
+        file_hash, ext = self._parse(stored_path)
+        try:
+            with self.recipes.open(self.recipes._address(file_hash, ext)) as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise FileNotFoundError(stored_path) from None
+        (total,) = _RECIPE.unpack_from(data)
+        digests = [data[i : i + 32] for i in range(_RECIPE.size, len(data), 32)]
+        return total, digests
+
+    def _chunk_locations(self, stored_path: str) -> list[tuple[int, int, int]]:
+        # (pack fd, offset, length) of every chunk of a blob, in order
+        locations = []
+        for digest in self._recipe(stored_path)[1]:
+            found = self.chunks._find(digest.hex())
+            if found is None:
+                raise FileNotFoundError(stored_path)
+            number, offset, length, _ext = found
+            locations.append((self.chunks._fd(number), offset, length))
+        return locations
+
+    def _iter_chunk_data(self, stored_path: str):
+        for fd, offset, length in self._chunk_locations(stored_path):
+            yield os.pread(fd, length, offset)
+
+    def put(
+        self, src: Path, file_hash: str, ext: str, mode: str = "copy"
+    ) -> tuple[str, str | None]:
+        if not self._chunkable(file_hash, ext):
+            return super().put(src, file_hash, ext, mode)
+        if self.recipes._find(file_hash) is not None:
+            return self._address(file_hash, ext), None
+        with src.open("rb") as f:
+            self._store_chunks(f, ext, file_hash)
+        return self._address(file_hash, ext), "chunks"
+
+    def put_stream(
+        self, src: Path | BinaryIO, ext: str, algorithm: str | None = None
+    ) -> tuple[str, str, str]:
+        if not self._chunkable(None, ext):
+            return super().put_stream(src, ext, algorithm)
+        with _open_source(src) as f:
+            if _source_fd(f) is not None:
+                _advise_sequential(f.fileno())
+            file_hash = self._store_chunks(f, ext, algorithm=algorithm)
+        return file_hash, self._address(file_hash, ext), "chunks"
+
+    def copy(self, stored_path: str, file_hash: str, ext: str) -> str:
+        if self._parse(stored_path) is None:
+            return super().copy(stored_path, file_hash, ext)
+        # The new address shares the old blob's chunks
+        total, digests = self._recipe(stored_path)
+        recipe = _RECIPE.pack(total) + b"".join(digests)
+        self.recipes._append(io.BytesIO(recipe), ext, file_hash)
+        return self._address(file_hash, ext)
+
+    def exists(self, stored_path: str) -> bool:
+        parsed = self._parse(stored_path)
+        if parsed is None:
+            return super().exists(stored_path)
+        return self.recipes._find(parsed[0]) is not None
+
+    def size(self, stored_path: str) -> int:
+        if self._parse(stored_path) is None:
+            return super().size(stored_path)
+        return self._recipe(stored_path)[0]
+
+    def open(self, stored_path: str):
+        if self._parse(stored_path) is None:
+            return super().open(stored_path)
+        return io.BufferedReader(_ChunkReader(self._chunk_locations(stored_path)))
+
+    def hash(
+        self, stored_path: str, throttle=None, algorithm: str | None = None
+    ) -> str:
+        if self._parse(stored_path) is None:
+            return super().hash(stored_path, throttle, algorithm)
+        hasher = new_hasher(algorithm, self._recipe(stored_path)[0])
+        for data in self._iter_chunk_data(stored_path):
+            if throttle is not None:
+                throttle(len(data))
+            hasher.update(data)
+        return hasher.hexdigest()
+
+    def delete(self, stored_path: str) -> None:
+        parsed = self._parse(stored_path)
+        if parsed is None:
+            return super().delete(stored_path)
+        self.recipes.delete(self.recipes._address(*parsed))
+
+    def iter_chunked(self):
+        # Yields (hash, ext, stored_path) for every chunked blob.
+        for file_hash, ext, _path in self.recipes.iter_packed():
+            yield file_hash, ext, self._address(file_hash, ext)
+
+    def iter_blobs(self):
+        yield from super().iter_blobs()
+        yield from self.iter_chunked()
+
+    def repack(self) -> int:
+        """
+        Drops chunks no live recipe refers to, then repacks recipes and
+        chunks. Don't run it while another process writes to the store.
+        Returns the number of bytes reclaimed.
+        """
+        live = set()
+        for _hash, _ext, stored_path in self.iter_chunked():
+            live.update(digest.hex() for digest in self._recipe(stored_path)[1])
+        for chunk_hash, _ext, address in list(self.chunks.iter_packed()):
+            if chunk_hash not in live:
+                self.chunks.delete(address)
+        return self.recipes.repack() + self.chunks.repack()
+
+    def stats(self, sample: int = 100) -> dict[str, float]:
+        """
+        Reports how well the store dedups and what reassembly costs:
+        dedup_ratio is the size of all blobs over the size of their unique
+        chunks, and read_overhead is the time to reassemble up to `sample`
+        blobs over the time to read as many bytes sequentially from the
+        chunk packs (both mostly from the page cache on a second run).
+        """
+        blobs = logical = references = 0
+        sampled = []
+        for _hash, _ext, stored_path in self.iter_chunked():
+            total, digests = self._recipe(stored_path)
+            blobs += 1
+            logical += total
+            references += len(digests)
+            if len(sampled) < sample:
+                sampled.append(stored_path)
+        chunks = stored = 0
+        for *_location, length in self.chunks._records():
+            chunks += 1
+            stored += length
+
+        start = time.perf_counter()
+        read = 0
+        for stored_path in sampled:
+            with self.open(stored_path) as f:
+                read += len(f.read())
+        reassembly = time.perf_counter() - start
+
+        start = time.perf_counter()
+        remaining = read
+        for number in sorted([*self.chunks._sealed, *self.chunks._unsealed]):
+            fd = self.chunks._fd(number)
+            offset = 0
+            while remaining > 0:
+                data = os.pread(fd, min(CHUNK_SIZE, remaining), offset)
+                if not data:
+                    break
+                offset += len(data)
+                remaining -= len(data)
+        sequential = time.perf_counter() - start
+
+        return {
+            "blobs": blobs,
+            "chunks": chunks,
+            "logical_bytes": logical,
+            "stored_bytes": stored,
+            "dedup_ratio": logical / stored if stored else 0.0,
+            "chunks_per_blob": references / blobs if blobs else 0.0,
+            "read_overhead": reassembly / sequential if sequential else 0.0,
+        }
+
+
+class _ChunkReader(io.RawIOBase):
+    # A seekable view of a chunked blob that reads each chunk from its pack
+    # when reached, so a large blob is never held in memory whole
+
+    def __init__(self, locations: list[tuple[int, int, int]]):
+        self._locations = locations
+        self._starts = []
+        self._size = 0
+        for _fd, _offset, length in locations:
+            self._starts.append(self._size)
+            self._size += length
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}
+        self._pos = max(0, base[whence] + offset)
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        if self._pos >= self._size:
+            return 0
+        i = bisect.bisect_right(self._starts, self._pos) - 1
+        fd, offset, length = self._locations[i]
+        skip = self._pos - self._starts[i]
+        data = os.pread(fd, min(len(buffer), length - skip), offset + skip)
+        buffer[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+class _TrackedReader(io.BufferedReader):
+    # A file that counts as a busy read on its disk until closed
+
+    def __init__(self, path: Path, done):
+        super().__init__(io.FileIO(path, "rb"))
+        self._done = done
+
+    def close(self) -> None:
+        if not self.closed:
+            self._done()
+        super().close()
+
+
+class DiskBlobStore(FileBlobStore):
+    """
+    Spreads loose blobs over several disks (DISK_ROOTS, or the library root
+    alone) and addresses them as "disks:<hash>.<ext>". Each disk owns
+    RING_POINTS points on a hash ring; a blob lives on the first `replicas`
+    distinct disks clockwise from its hash, in the usual <ext>/ab/cd layout
+    of that disk.
+
+    Reads go to the replica with the fewest reads in flight and fall back to
+    the other disks, so a newly added disk works before rebalance() has
+    moved anything onto it. Because of the ring, adding one disk to n only
+    reassigns about 1/(n+1) of the blobs.
+    """
+
+    scheme = "disks"
+
+    def __init__(
+        self, roots: list[str | Path] | None = None, replicas: int | None = None
+    ):
+        roots = roots or DISK_ROOTS or [DEFAULT_LIBRARY_ROOT]
+        self.disks = [FileBlobStore(root) for root in roots]
+        self.replica_count = min(replicas or REPLICAS, len(self.disks))
+        self._busy = {id(disk): 0 for disk in self.disks}
+        self._busy_lock = threading.Lock()
+        points = []
+        for disk in self.disks:
+            for i in range(RING_POINTS):
+                point = hashlib.blake2b(f"{disk.root}#{i}".encode(), digest_size=8)
+                points.append((int.from_bytes(point.digest(), "big"), disk))
+        points.sort(key=lambda point: point[0])
+        self._points = [point for point, _disk in points]
+        self._owners = [disk for _point, disk in points]
+
+    def replicas(self, file_hash: str) -> list[FileBlobStore]:
+        # The disks a blob belongs on, in ring order.
+        start = bisect.bisect(self._points, int(file_hash[:16], 16))
+        chosen = []
+        for i in range(len(self._owners)):
+            disk = self._owners[(start + i) % len(self._owners)]
+            if disk not in chosen:
+                chosen.append(disk)
+                if len(chosen) == self.replica_count:
+                    break
+        return chosen
+
+    @contextlib.contextmanager
+    def _reading(self, disk: FileBlobStore):
+        with self._busy_lock:
+            self._busy[id(disk)] += 1
+        try:
+            yield
+        finally:
+            self._release(disk)
+
+    def _release(self, disk: FileBlobStore) -> None:
+        with self._busy_lock:
+            self._busy[id(disk)] -= 1
+
+    def _locate(self, stored_path: str) -> tuple[FileBlobStore, Path]:
+        # The least busy disk holding the blob, and its path there
+        file_hash, ext = self._parse(stored_path)
+        replicas = self.replicas(file_hash)
+        with self._busy_lock:
+            replicas.sort(key=lambda disk: self._busy[id(disk)])
+        for disk in replicas + [d for d in self.disks if d not in replicas]:
+            path = blob_path(file_hash, ext, root=disk.root)
+            if path.exists():
+                return disk, path
+        raise FileNotFoundError(stored_path)
+
+    def put(
+        self, src: Path, file_hash: str, ext: str, mode: str = "copy"
+    ) -> tuple[str, str | None]:
+        used = None
+        first = None
+        for disk in self.replicas(file_hash):
+            if first is None:
+                path, used = disk.put(src, file_hash, ext, mode)
+                first = Path(path)
+            else:
+                # Other disks get a real copy; links can't cross devices
+                _path, copied = disk.put(first, file_hash, ext, "copy")
+                used = used or copied
+        return self._address(file_hash, ext), used
+
+    def put_stream(
+        self,
+        src: Path | BinaryIO,
+        ext: str,
+        algorithm: str | None = None,
+        file_hash: str | None = None,
+    ) -> tuple[str, str, str]:
+        """
+        Blobs are placed by hash, so a source that can be re-read is hashed
+        first and then written only to its ring disks. Other streams are
+        copied to the least busy disk while hashed, then to their ring disks.
+        """
+        with _open_source(src) as f:
+            if file_hash is None and f.seekable():
+                start = f.tell()
+                if _source_fd(f) is not None:
+                    file_hash = hash_file(f, algorithm=algorithm)
+                else:
+                    data = f.read()
+                    hasher = new_hasher(algorithm, len(data))
+                    hasher.update(data)
+                    file_hash = hasher.hexdigest()
+                f.seek(start)
+            if file_hash is not None:
+                replicas = self.replicas(file_hash)
+                _hash, path, mode = replicas[0].put_stream(f, ext, algorithm, file_hash)
+                for replica in replicas[1:]:
+                    replica.put(Path(path), file_hash, ext, "copy")
+                return file_hash, self._address(file_hash, ext), mode
+            return self._put_unhashed(f, ext, algorithm)
+
+    def _put_unhashed(
+        self, f: BinaryIO, ext: str, algorithm: str | None
+    ) -> tuple[str, str, str]:
+        # Stream to the least busy disk, then copy to where the ring says
+        with self._busy_lock:
+            disk = min(self.disks, key=lambda d: self._busy[id(d)])
+        file_hash, path, mode = disk.put_stream(f, ext, algorithm)
+        replicas = self.replicas(file_hash)
+        for replica in replicas:
+            if replica is not disk:
+                replica.put(Path(path), file_hash, ext, "copy")
+        if disk not in replicas:
+            disk.delete(path)
+        return file_hash, self._address(file_hash, ext), mode
+
+    def copy(self, stored_path: str, file_hash: str, ext: str) -> str:
+        if self._parse(stored_path) is None:
+            return super().copy(stored_path, file_hash, ext)
+        _disk, path = self._locate(stored_path)
+        for replica in self.replicas(file_hash):
+            replica.copy(str(path), file_hash, ext)
+        return self._address(file_hash, ext)
+
+    def exists(self, stored_path: str) -> bool:
+        if self._parse(stored_path) is None:
+            return super().exists(stored_path)
+        try:
+            self._locate(stored_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def size(self, stored_path: str) -> int:
+        if self._parse(stored_path) is None:
+            return super().size(stored_path)
+        return os.stat(self._locate(stored_path)[1]).st_size
+
+    def open(self, stored_path: str):
+        if self._parse(stored_path) is None:
+            return super().open(stored_path)
+        disk, path = self._locate(stored_path)
+        with self._busy_lock:
+            self._busy[id(disk)] += 1
+        try:
+            return _TrackedReader(path, lambda: self._release(disk))
+        except BaseException:
+            self._release(disk)
+            raise
+
+    def hash(
+        self, stored_path: str, throttle=None, algorithm: str | None = None
+    ) -> str:
+        if self._parse(stored_path) is None:
+            return super().hash(stored_path, throttle, algorithm)
+        disk, path = self._locate(stored_path)
+        with self._reading(disk):
+            return compute_hash(path, throttle, algorithm)
+
+    def delete(self, stored_path: str) -> None:
+        parsed = self._parse(stored_path)
+        if parsed is None:
+            return super().delete(stored_path)
+        for disk in self.disks:
+            disk.delete(str(blob_path(*parsed, root=disk.root)))
+
+    def iter_disks(self):
+        # Yields (hash, ext, stored_path) once for every blob on any disk.
+        seen = set()
+        for disk in self.disks:
+            for file_hash, ext, _path in disk.iter_blobs():
+                if (file_hash, ext) not in seen:
+                    seen.add((file_hash, ext))
+                    yield file_hash, ext, self._address(file_hash, ext)
+
+    def iter_blobs(self):
+        yield from self.iter_disks()
+
+    def rebalance(self) -> dict[str, int]:
+        """
+        Puts every blob on the disks the ring assigns it, e.g. after a disk
+        was added or the replica count raised. Only blobs whose disks changed
+        are copied, and a copy is removed only once all of its blob's
+        replicas are in place. Returns the number of copies made and removed.
+        """
+        holders = {}
+        for disk in self.disks:
+            for file_hash, ext, _path in disk.iter_blobs():
+                holders.setdefault((file_hash, ext), []).append(disk)
+
+        copied = removed = 0
+        for (file_hash, ext), disks in holders.items():
+            replicas = self.replicas(file_hash)
+            source = blob_path(file_hash, ext, root=disks[0].root)
+            for replica in replicas:
+                if replica not in disks:
+                    replica.put(source, file_hash, ext, "copy")
+                    copied += 1
+            for disk in disks:
+                if disk not in replicas:
+                    disk.delete(str(blob_path(file_hash, ext, root=disk.root)))
+                    removed += 1
+        return {"copied": copied, "removed": removed}
+
+
+_STORE_TYPES = {
+    "files": FileBlobStore,
+    "pack": PackBlobStore,
+    "chunks": ChunkBlobStore,
+    "disks": DiskBlobStore,
+}
+# stored_path schemes and the store that reads them
+_SCHEMES = {"pack": "pack", "chunks": "chunks", "disks": "disks"}
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _reset_stores() -> None:
+    # Forked children must not share pack fds or a lock held at fork time
+    global _stores_lock
+    _stores.clear()
+    _stores_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_stores)
+
+
+def _store(name: str) -> FileBlobStore:
+    with _stores_lock:
+        if name not in _stores:
+            _stores[name] = _STORE_TYPES[name]()
+        return _stores[name]
+
+
+def get_blob_store(name: str | None = None) -> FileBlobStore:
+    # The store new blobs are written to (BLOB_STORE unless given).
+    name = name or BLOB_STORE
+    if name not in _STORE_TYPES:
+        raise ValueError(f"Unknown blob store: {name}")
+    return _store(name)
+
+
+def blob_scheme(stored_path: str | Path) -> str | None:
+    # "pack" etc. for blobs addressed by scheme, None for plain file paths.
+    match = _SCHEME_RE.fullmatch(str(stored_path))
+    if match is not None and match.group(1) in _SCHEMES:
+        return match.group(1)
+    return None
+
+
+def blob_key(stored_path: str | Path) -> str:
+    # Comparable form of a stored_path: plain paths are made absolute.
+    if blob_scheme(stored_path):
+        return str(stored_path)
+    return os.path.abspath(stored_path)
+
+
+def resolve(stored_path: str | Path) -> FileBlobStore:
+    # The store holding the blob at stored_path, whatever BLOB_STORE is now.
+    scheme = blob_scheme(stored_path)
+    return _store(_SCHEMES[scheme] if scheme else "files")
+
+
+def blob_exists(stored_path: str | Path) -> bool:
+    return resolve(stored_path).exists(str(stored_path))
+
+
+def blob_size(stored_path: str | Path) -> int:
+    return resolve(stored_path).size(str(stored_path))
+
+
+def open_blob(stored_path: str | Path):
+    # Binary file object over a blob; a plain path is opened as a file.
+    return resolve(stored_path).open(str(stored_path))
+
+
+def hash_blob(
+    stored_path: str | Path, throttle=None, algorithm: str | None = None
+) -> str:
+    return resolve(stored_path).hash(str(stored_path), throttle, algorithm)
+
+
+def delete_blob(stored_path: str | Path) -> None:
+    resolve(stored_path).delete(str(stored_path))
+
+
+def iter_stored_blobs():
+    # Yields (hash, ext, stored_path) for every blob in every store in use.
+    on_disks = set()
+    if BLOB_STORE == "disks" or DISK_ROOTS:
+        # Without LIBRARY_DISKS the disks store is the library root itself,
+        # so its blobs there aren't listed again as plain files
+        disks = _store("disks")
+        shares_root = any(
+            _same_file(disk.root, DEFAULT_LIBRARY_ROOT) for disk in disks.disks
+        )
+        for file_hash, ext, stored_path in disks.iter_disks():
+            if shares_root:
+                on_disks.add((file_hash, ext))
+            yield file_hash, ext, stored_path
+    for file_hash, ext, path in _store("files").iter_blobs():
+        if (file_hash, ext) not in on_disks:
+            yield file_hash, ext, path
+    if PACK_DIR.exists():
+        yield from _store("pack").iter_packed()
+    if CHUNK_DIR.exists():
+        yield from _store("chunks").iter_chunked()
+
+
+def _same_file(a: str | Path, b: str | Path) -> bool:
+    try:
+        return os.path.samefile(a, b)
+    except OSError:
+        return False
+
+
+def move_library(name: str = "pack") -> int:
+    """
+    Moves every loose blob into the named store ("pack", "chunks" or
+    "disks") and repoints its index entry; blobs the store keeps loose
+    (e.g. too large to pack) stay where they are. The old files are removed
+    once the index is saved, unless the new store uses them in place.
+    Returns the number of blobs moved.
+    """
+    store = get_blob_store(name)
+    index = load_index()
+    moved = []
+    for entry in index:
+        old_path = entry["stored_path"]
+        if blob_scheme(old_path) is not None:
+            continue
+        file_hash, ext = entry["hash"], entry["format"]
+        try:
+            new_path, mode = store.put(Path(old_path), file_hash, ext)
+        except FileNotFoundError:
+            print(f"Missing blob for {file_hash}: {old_path}")
+            continue
+        if new_path == old_path:
+            continue
+        entry["stored_path"] = new_path
+        if mode is not None:
+            entry["storage_mode"] = mode
+        metadata = entry.get("metadata") or {}
+        if metadata.get("path") == old_path:
+            metadata["path"] = new_path
+        moved.append((old_path, file_hash, ext))
+
+    if moved:
+        save_index(index)
+    for old_path, file_hash, ext in moved:
+        disks = store.replicas(file_hash) if isinstance(store, DiskBlobStore) else []
+        if not any(
+            _same_file(old_path, blob_path(file_hash, ext, root=disk.root))
+            for disk in disks
+        ):
+            FileBlobStore().delete(old_path)
+    return len(moved)
+
+
+if __name__ == "__main__":
+    # Usage: python -m app.blobstore move <pack|chunks|disks>
+    #        python -m app.blobstore repack [pack|chunks]
+    #        python -m app.blobstore rebalance
+    #        python -m app.blobstore chunk-stats
+    if sys.argv[1:2] == ["move"]:
+        print(f"Moved {move_library(sys.argv[2])} blobs")
+    elif sys.argv[1:2] == ["rebalance"]:
+        result = _store("disks").rebalance()
+        print(f"Copied {result['copied']} and removed {result['removed']} blobs")
+    elif sys.argv[1:2] == ["repack"]:
+        name = sys.argv[2] if len(sys.argv) > 2 else "pack"
+        print(f"Reclaimed {_store(name).repack()} bytes")
+    elif sys.argv[1:2] == ["chunk-stats"]:
+        stats = _store("chunks").stats()
+        print(
+            f"{stats['blobs']} blobs, {stats['logical_bytes']} bytes in "
+            f"{stats['chunks']} chunks of {stats['stored_bytes']} bytes"
+        )
+        print(f"Dedup ratio: {stats['dedup_ratio']:.2f}x")
+        print(f"Chunks per blob: {stats['chunks_per_blob']:.1f}")
+        print(f"Read overhead: {stats['read_overhead']:.2f}x a sequential read")
+    else:
+        print("Usage: python -m app.blobstore move <pack|chunks|disks>")
+        print("       python -m app.blobstore repack [pack|chunks]")
+        print("       python -m app.blobstore rebalance")
+        print("       python -m app.blobstore chunk-stats")
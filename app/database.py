@@ -0,0 +1,398 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+
+from .utils import DEFAULT_LIBRARY_ROOT, INDEX_FILE, compact_index, load_cache
+
+INDEX_DB = DEFAULT_LIBRARY_ROOT / "library.db"
+# Rows per executemany call when writing entries
+BATCH_SIZE = 1000
+# Page cache per connection; FTS5 segment merges on large imports need it
+CACHE_SIZE_KB = 64 * 1024
+# bm25 weights of the title, author and Hardcover columns in ranked search
+FTS_WEIGHTS = (10.0, 5.0, 1.0)
+_COLUMNS = (
+    "hash",
+    "format",
+    "title",
+    "author",
+    "title_lower",
+    "author_lower",
+    "size",
+    "algorithm",
+    "stored_path",
+    "entry",
+)
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    hash TEXT PRIMARY KEY,
+    format TEXT NOT NULL,
+    title TEXT,
+    author TEXT,
+    title_lower TEXT,
+    author_lower TEXT,
+    size INTEGER,
+    algorithm TEXT NOT NULL,
+    stored_path TEXT NOT NULL,
+    entry TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS books_format ON books (format);
+CREATE INDEX IF NOT EXISTS books_title ON books (title_lower);
+CREATE INDEX IF NOT EXISTS books_author ON books (author_lower);
+CREATE INDEX IF NOT EXISTS books_size ON books (size);
+CREATE TABLE IF NOT EXISTS hardcover (
+    key TEXT PRIMARY KEY,
+    title_lower TEXT,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hardcover_title ON hardcover (title_lower);
+CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5 (
+    title,
+    author,
+    hardcover,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+);
+"""
+# Hardcover text of the books with a given lowercased title
+_HARDCOVER_TEXT = (
+    "(SELECT group_concat(text, ' ') FROM hardcover WHERE title_lower = {})"
+)
+
+
+def _fts_insert(where: str) -> str:
+    return (
+        "INSERT INTO books_fts (rowid, title, author, hardcover) "
+        "SELECT rowid, title, author, "
+        + _HARDCOVER_TEXT.format("books.title_lower")
+        + f" FROM books WHERE {where};"
+    )
+
+
+def _fts_refresh(title_lower: str) -> str:
+    # Re-index the books with a title, after its Hardcover rows changed
+    where = f"title_lower = {title_lower}"
+    return (
+        f"DELETE FROM books_fts WHERE rowid IN (SELECT rowid FROM books WHERE {where});"
+        + _fts_insert(where)
+    )
+
+
+# books_fts follows books, and the Hardcover rows matched to them by title
+_TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+    {_fts_insert("rowid = new.rowid")}
+END;
+CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+    DELETE FROM books_fts WHERE rowid = old.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE ON books
+WHEN old.title IS NOT new.title OR old.author IS NOT new.author BEGIN
+    DELETE FROM books_fts WHERE rowid = old.rowid;
+    {_fts_insert("rowid = new.rowid")}
+END;
+CREATE TRIGGER IF NOT EXISTS hardcover_fts_insert AFTER INSERT ON hardcover BEGIN
+    {_fts_refresh("new.title_lower")}
+END;
+CREATE TRIGGER IF NOT EXISTS hardcover_fts_delete AFTER DELETE ON hardcover BEGIN
+    {_fts_refresh("old.title_lower")}
+END;
+CREATE TRIGGER IF NOT EXISTS hardcover_fts_update AFTER UPDATE ON hardcover BEGIN
+    {_fts_refresh("old.title_lower")}
+    {_fts_refresh("new.title_lower")}
+END;
+"""
+_UPSERT = (
+    f"INSERT INTO books ({', '.join(_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in _COLUMNS)}) "
+    "ON CONFLICT (hash) DO UPDATE SET "
+    + ", ".join(f"{c} = excluded.{c}" for c in _COLUMNS[1:])
+)
+
+
+def _row(entry: dict) -> tuple:
+    # Column values for an index entry; the entry itself is kept as JSON
+    metadata = entry.get("metadata") or {}
+    title = metadata.get("title")
+    author = metadata.get("author")
+    return (
+        entry["hash"],
+        entry["format"],
+        title,
+        author,
+        title.lower() if title else None,
+        author.lower() if author else None,
+        entry.get("size"),
+        entry.get("algorithm", "sha256"),
+        str(entry["stored_path"]),
+        json.dumps(entry, ensure_ascii=False),
+    )
+
+
+def _hardcover_row(key: str, metadata: dict) -> tuple:
+    # Searchable text of a Hardcover cache entry, matched to books by title
+    title = metadata.get("title")
+    parts = [title, metadata.get("slug"), str(metadata.get("release_date") or "")]
+    parts += metadata.get("authors") or []
+    parts += metadata.get("isbns") or []
+    text = " ".join(str(part) for part in parts if part)
+    return key, title.lower() if title else None, text
+
+
+def _fts_query(text: str, prefix: bool = True) -> str:
+    # Every word must match, as a prefix by default; quoting keeps FTS5
+    # operators in the words literal
+    star = "*" if prefix else ""
+    return " ".join('"' + word.replace('"', '""') + '"' + star for word in text.split())
+
+
+def _like(needle: str) -> str:
+    # LIKE pattern matching needle anywhere, with wildcards escaped
+    needle = needle.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{needle}%"
+
+
+class LibraryDB:
+    """
+    The library index in SQLite, in WAL mode so readers never block the
+    ingest writer. Every entry is a row keyed by hash, with its format,
+    title, author and size in indexed columns and the whole entry as JSON,
+    so entries round-trip with every field the JSON index had.
+    Title and author are also stored lowercased, so searches don't lowercase
+    every row on every call. One connection is shared by the threads of a
+    process behind a lock.
+
+    Triggers keep the books_fts FTS5 table in step with the books table and
+    with the Hardcover cache (the hardcover table), whose entries are
+    matched to books by lowercased title. A database made before the FTS
+    table existed is indexed, and the cache loaded, when it is first opened.
+    """
+
+    def __init__(self, path: str | Path = INDEX_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
+        had_fts = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'books_fts'"
+        ).fetchone()
+        self.conn.executescript(_SCHEMA + _TRIGGERS)
+        if not had_fts:
+            self.rebuild_fts()
+            self.sync_hardcover(load_cache())
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+    def _query(self, sql: str, params=()) -> list[dict]:
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [json.loads(entry) for (entry,) in rows]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT count(*) FROM books").fetchone()[0]
+
+    def get(self, file_hash: str) -> dict | None:
+        entries = self._query("SELECT entry FROM books WHERE hash = ?", (file_hash,))
+        return entries[0] if entries else None
+
+    def entries(self) -> list[dict]:
+        # Every entry, in the order they were first added
+        return self._query("SELECT entry FROM books ORDER BY rowid")
+
+    def by_size(self, size: int) -> list[dict]:
+        return self._query("SELECT entry FROM books WHERE size = ?", (size,))
+
+    def algorithms(self) -> set[str]:
+        with self._lock:
+            rows = self.conn.execute("SELECT DISTINCT algorithm FROM books").fetchall()
+        return {algorithm for (algorithm,) in rows}
+
+    def upsert(self, entries) -> int:
+        """
+        Inserts entries, replacing any row with the same hash, in one
+        transaction of BATCH_SIZE executemany calls. Returns the row count.
+        """
+        rows = [_row(entry) for entry in entries]
+        with self._lock, self.conn:
+            for start in range(0, len(rows), BATCH_SIZE):
+                self.conn.executemany(_UPSERT, rows[start : start + BATCH_SIZE])
+        return len(rows)
+
+    def delete(self, hashes) -> None:
+        params = [(file_hash,) for file_hash in hashes]
+        with self._lock, self.conn:
+            for start in range(0, len(params), BATCH_SIZE):
+                self.conn.executemany(
+                    "DELETE FROM books WHERE hash = ?",
+                    params[start : start + BATCH_SIZE],
+                )
+
+    def replace(self, entries: list[dict]) -> None:
+        """
+        Makes the table hold exactly `entries`, the way save_index rewrites
+        the JSON index, but only writes rows that changed.
+        """
+        with self._lock:
+            current = dict(self.conn.execute("SELECT hash, entry FROM books"))
+        changed = []
+        for entry in entries:
+            row = _row(entry)
+            if current.pop(entry["hash"], None) != row[-1]:
+                changed.append(entry)
+        self.upsert(changed)
+        self.delete(current)
+
+    def sync_hardcover(self, cache: dict) -> None:
+        # Make the hardcover table match the Hardcover cache (see load_cache)
+        rows = [_hardcover_row(key, metadata) for key, metadata in cache.items()]
+        with self._lock, self.conn:
+            current = set(
+                self.conn.execute("SELECT key, title_lower, text FROM hardcover")
+            )
+            keys = {row[0] for row in rows}
+            self.conn.executemany(
+                "DELETE FROM hardcover WHERE key = ?",
+                [(row[0],) for row in current if row[0] not in keys],
+            )
+            self.conn.executemany(
+                "INSERT INTO hardcover (key, title_lower, text) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET "
+                "title_lower = excluded.title_lower, text = excluded.text",
+                [row for row in rows if row not in current],
+            )
+
+    def rebuild_fts(self) -> None:
+        # Re-index every book from scratch
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM books_fts")
+            self.conn.execute(_fts_insert("1"))
+
+    def full_text_search(
+        self, query: str, limit: int | None = 50, prefix: bool = True
+    ) -> list[dict]:
+        """
+        Ranked search over titles, authors and matched Hardcover fields.
+        Every word of the query must match a word in the book (as a prefix
+        unless `prefix` is False), case- and accent-insensitively. Results
+        are ordered by bm25 with FTS_WEIGHTS, best first.
+        """
+        match = _fts_query(query, prefix)
+        if not match:
+            return []
+        sql = (
+            "SELECT books.entry FROM books_fts "
+            "JOIN books ON books.rowid = books_fts.rowid "
+            "WHERE books_fts MATCH ? ORDER BY bm25(books_fts, ?, ?, ?)"
+        )
+        params = [match, *FTS_WEIGHTS]
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._query(sql, params)
+
+    def filter(
+        self,
+        title: str | None = None,
+        author: str | None = None,
+        fmt: str | None = None,
+        mode: str = "strict",
+    ) -> list[dict]:
+        """
+        filter_library in SQL: books whose title or author matches (OR),
+        optionally of one format. "strict" matches each query as a substring;
+        "relaxed" matches every word of it anywhere.
+        """
+        matches = []
+        params = []
+        for column, needle in (("title_lower", title), ("author_lower", author)):
+            if not needle:
+                continue
+            if mode == "strict":
+                words = [needle.lower()]
+            else:
+                words = needle.lower().split() or [""]
+            matches.append(
+                "(" + " AND ".join(f"{column} LIKE ? ESCAPE '\\'" for _ in words) + ")"
+            )
+            params.extend(_like(word) for word in words)
+        where = [f"({' OR '.join(matches)})"] if matches else []
+        if fmt:
+            where.append("format = ?")
+            params.append(fmt.lower())
+        sql = "SELECT entry FROM books"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return self._query(sql + " ORDER BY rowid", params)
+
+    def search(self, query: str) -> list[dict]:
+        # strict_search_library in SQL: query as a substring of title or author
+        pattern = _like(query.lower())
+        return self._query(
+            "SELECT entry FROM books WHERE title_lower LIKE ? ESCAPE '\\' "
+            "OR author_lower LIKE ? ESCAPE '\\' ORDER BY rowid",
+            (pattern, pattern),
+        )
+
+
+_dbs = {}
+_dbs_lock = threading.Lock()
+
+
+def _reset_dbs() -> None:
+    # A connection must not be used on both sides of a fork
+    global _dbs_lock
+    _dbs.clear()
+    _dbs_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_dbs)
+
+
+def get_db(path: str | Path | None = None) -> LibraryDB:
+    # The process-wide connection to an index database (INDEX_DB by default).
+    path = Path(path or INDEX_DB)
+    with _dbs_lock:
+        if path not in _dbs:
+            _dbs[path] = LibraryDB(path)
+        return _dbs[path]
+
+
+def import_json(path: str | Path = INDEX_FILE) -> int:
+    # Load a JSON index into the database; returns the number of entries.
+    if Path(path) == INDEX_FILE:
+        compact_index()  # fold in changes still in the index log
+    with Path(path).open("r", encoding="utf-8") as f:
+        entries = json.load(f)
+    get_db().replace(entries)
+    return len(entries)
+
+
+if __name__ == "__main__":
+    # Usage: python -m app.database import-json [index.json]
+    #        python -m app.database reindex
+    #        python -m app.database search <words ...>
+    if sys.argv[1:2] == ["import-json"]:
+        count = import_json(*sys.argv[2:3])
+        print(f"Imported {count} entries into {INDEX_DB}")
+    elif sys.argv[1:2] == ["reindex"]:
+        db = get_db()
+        db.sync_hardcover(load_cache())
+        db.rebuild_fts()
+        print(f"Re-indexed {len(db)} books")
+    elif sys.argv[1:2] == ["search"]:
+        for entry in get_db().full_text_search(" ".join(sys.argv[2:])):
+            metadata = entry.get("metadata") or {}
+            print(f"- {metadata.get('title')} by {metadata.get('author')}")
+    else:
+        print("Usage: python -m app.database import-json [index.json]")
+        print("       python -m app.database reindex")
+        print("       python -m app.database search <words ...>")
@@ -0,0 +1,114 @@
+import os
+import struct
+
+# Bytes read from the start of a file to identify its format
+SNIFF_SIZE = 512
+# Formats import_folder and the watcher ingest by default
+BOOK_FORMATS = frozenset(
+    {
+        "epub",
+        "pdf",
+        "mobi",
+        "azw3",
+        "azw",
+        "cbz",
+        "cbr",
+        "cb7",
+        "fb2",
+        "fbz",
+        "djvu",
+        "pdb",
+        "lit",
+        "chm",
+        "rtf",
+    }
+)
+_IMAGE_SUFFIXES = (b".jpg", b".jpeg", b".png", b".gif", b".webp", b".bmp")
+_MAGIC = [
+    (b"%PDF-", "pdf"),
+    (b"Rar!\x1a\x07", "cbr"),
+    (b"7z\xbc\xaf\x27\x1c", "cb7"),
+    (b"ITOLITLS", "lit"),
+    (b"ITSF", "chm"),
+    (b"{\\rtf", "rtf"),
+]
+
+
+class UnsupportedFormatError(ValueError):
+    """A file whose format is unknown or not wanted."""
+
+
+def _sniff_zip(head: bytes) -> str | None:
+    # Walk the local file headers that fit in head
+    offset = 0
+    while head[offset : offset + 4] == b"PK\x03\x04" and offset + 30 <= len(head):
+        flags, _method = struct.unpack_from("<HH", head, offset + 6)
+        (compressed_size,) = struct.unpack_from("<I", head, offset + 18)
+        name_len, extra_len = struct.unpack_from("<HH", head, offset + 26)
+        name = head[offset + 30 : offset + 30 + name_len].lower()
+        data = offset + 30 + name_len + extra_len
+        if offset == 0 and name == b"mimetype":
+            # OCF puts an uncompressed mimetype member first
+            if head[data : data + 20] == b"application/epub+zip":
+                return "epub"
+            return None
+        if name.endswith(b"/") or name == b"comicinfo.xml":
+            if flags & 0x08:
+                return None  # size follows the data; can't skip ahead
+            offset = data + compressed_size
+            continue
+        if name.endswith(_IMAGE_SUFFIXES):
+            return "cbz"
+        if name.endswith(b".fb2"):
+            return "fbz"
+        return None
+    return None
+
+
+def _sniff_mobi(head: bytes, read_at) -> str:
+    # KF8 (azw3) has MOBI header version 8; hybrids and older files are mobi
+    (record0,) = struct.unpack_from(">I", head, 78)
+    if record0 + 40 <= len(head):
+        header = head[record0 : record0 + 40]
+    elif read_at is not None:
+        header = read_at(record0, 40)
+    else:
+        return "mobi"
+    if header[16:20] == b"MOBI" and len(header) >= 40:
+        (version,) = struct.unpack_from(">I", header, 36)
+        if version >= 8:
+            return "azw3"
+    return "mobi"
+
+
+def sniff_format(head: bytes, read_at=None) -> str | None:
+    """
+    Identifies a book format from the first SNIFF_SIZE bytes of a file and
+    returns its usual extension, or None if it isn't recognised.
+    `read_at(offset, size)` reads elsewhere in the file; it is only used to
+    tell azw3 from older MOBI files when their header lies past `head`.
+    """
+    if head.startswith(b"PK\x03\x04"):
+        return _sniff_zip(head)
+    if head[60:68] == b"BOOKMOBI" and len(head) >= 82:
+        return _sniff_mobi(head, read_at)
+    if head[60:68] == b"TEXtREAd":
+        return "pdb"
+    if head.startswith(b"AT&TFORM") and head[12:16] in (b"DJVU", b"DJVM"):
+        return "djvu"
+    for magic, fmt in _MAGIC:
+        if head.startswith(magic):
+            return fmt
+    if b"%PDF-" in head[:SNIFF_SIZE]:
+        return "pdf"  # some PDFs have junk before the header
+    if b"<FictionBook" in head:
+        return "fb2"
+    return None
+
+
+def sniff_file(f) -> str | None:
+    # Sniff an open binary file with pread, leaving its position alone.
+    fd = f.fileno()
+    return sniff_format(
+        os.pread(fd, SNIFF_SIZE, 0), lambda offset, size: os.pread(fd, size, offset)
+    )
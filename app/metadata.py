@@ -1,15 +1,33 @@
+import contextlib
+import re
+import struct
 import xml.etree.ElementTree as ET
 import zipfile
 from pathlib import Path
+from typing import BinaryIO
 
+# Bytes read from each end of a PDF when looking for its Info dictionary
+PDF_SCAN_SIZE = 64 * 1024
+_PDF_STRING = rb"\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f\s]*>"
+_PDF_ESCAPES = {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"\b", b"f": b"\f"}
 
-def extract_epub_metadata(epub_path: str | Path) -> dict[str, str | None]:
-    """Extracts metadata from an EPUB file."""
-    epub_path = Path(epub_path)
-    if not epub_path.exists():
-        raise FileNotFoundError(epub_path)
 
-    with zipfile.ZipFile(epub_path, "r") as zf:
+@contextlib.contextmanager
+def _open_with_path(source: str | Path | BinaryIO):
+    # Yields (binary file, path) for a path or an open file object
+    if hasattr(source, "read"):
+        yield source, getattr(source, "name", None)
+        return
+    source = Path(source)
+    if not source.exists():
+        raise FileNotFoundError(source)
+    with source.open("rb") as f:
+        yield f, str(source)
+
+
+def extract_epub_metadata(epub_path: str | Path | BinaryIO) -> dict[str, str | None]:
+    """Extracts metadata from an EPUB file, given its path or a binary file object."""
+    with _open_with_path(epub_path) as (f, path), zipfile.ZipFile(f, "r") as zf:
         # Find package document (OPF) file path
         container = zf.read("META-INF/container.xml")
         tree = ET.fromstring(container)
@@ -33,5 +51,133 @@ def extract_epub_metadata(epub_path: str | Path) -> dict[str, str | None]:
         return {
             "title": title_el.text if title_el is not None else None,
             "author": author_el.text if author_el is not None else None,
-            "path": str(epub_path),
+            "path": path,
         }
+
+
+def extract_fb2_metadata(fb2_path: str | Path | BinaryIO) -> dict[str, str | None]:
+    """Extracts title and first author from the title-info of a FictionBook file."""
+    title = author = None
+    with _open_with_path(fb2_path) as (f, path):
+        # Stop parsing at the end of title-info, before the body and binaries
+        for _, el in ET.iterparse(f, events=("end",)):
+            tag = el.tag.rpartition("}")[2]
+            if tag == "book-title" and title is None:
+                title = el.text
+            elif tag == "author" and author is None:
+                names = [
+                    el.findtext(f"{{*}}{part}")
+                    for part in ("first-name", "middle-name", "last-name")
+                ]
+                author = " ".join(n.strip() for n in names if n and n.strip()) or None
+            elif tag == "title-info":
+                break
+    return {"title": title, "author": author, "path": path}
+
+
+def extract_fbz_metadata(fbz_path: str | Path | BinaryIO) -> dict[str, str | None]:
+    """Extracts metadata from the first FictionBook file in a zip."""
+    with _open_with_path(fbz_path) as (f, path), zipfile.ZipFile(f, "r") as zf:
+        name = next(n for n in zf.namelist() if n.lower().endswith(".fb2"))
+        with zf.open(name) as member:
+            metadata = extract_fb2_metadata(member)
+    return {**metadata, "path": path}
+
+
+def extract_mobi_metadata(mobi_path: str | Path | BinaryIO) -> dict[str, str | None]:
+    """
+    Extracts metadata from a MOBI or AZW3 file: the full name from the MOBI
+    header, overridden by the EXTH updated title (503), and the EXTH author (100).
+    """
+    with _open_with_path(mobi_path) as (f, path):
+        header = f.read(86)
+        if header[60:68] != b"BOOKMOBI":
+            raise ValueError("Not a MOBI file")
+        (record0,) = struct.unpack_from(">I", header, 78)
+        f.seek(record0)
+        record = f.read(64 * 1024)
+    if record[16:20] != b"MOBI":
+        raise ValueError("MOBI header not found")
+
+    header_len, _, encoding = struct.unpack_from(">III", record, 20)
+    codec = "utf-8" if encoding == 65001 else "cp1252"
+    name_offset, name_len = struct.unpack_from(">II", record, 84)
+    title = record[name_offset : name_offset + name_len].decode(codec, "replace")
+    author = None
+    (exth_flags,) = struct.unpack_from(">I", record, 128)
+    exth = 16 + header_len
+    if exth_flags & 0x40 and record[exth : exth + 4] == b"EXTH":
+        (count,) = struct.unpack_from(">I", record, exth + 8)
+        pos = exth + 12
+        for _ in range(count):
+            kind, length = struct.unpack_from(">II", record, pos)
+            value = record[pos + 8 : pos + length].decode(codec, "replace")
+            if kind == 100 and author is None:
+                author = value
+            elif kind == 503:
+                title = value
+            pos += length
+    return {"title": title or None, "author": author, "path": path}
+
+
+def extract_cbz_metadata(cbz_path: str | Path | BinaryIO) -> dict[str, str | None]:
+    """Extracts title and writer from a comic archive's ComicInfo.xml, if any."""
+    title = author = None
+    with _open_with_path(cbz_path) as (f, path), zipfile.ZipFile(f, "r") as zf:
+        names = {n.lower(): n for n in zf.namelist()}
+        if "comicinfo.xml" in names:
+            info = ET.fromstring(zf.read(names["comicinfo.xml"]))
+            title = info.findtext("Title") or info.findtext("Series")
+            author = info.findtext("Writer")
+    return {"title": title, "author": author, "path": path}
+
+
+def _pdf_text(raw: bytes) -> str:
+    # Decode a PDF literal or hex string (UTF-16 with a BOM, else Latin-1)
+    if raw.startswith(b"<"):
+        data = bytes.fromhex(raw[1:-1].decode("ascii"))
+    else:
+        data = re.sub(
+            rb"\\([nrtbf()\\]|[0-7]{1,3})",
+            lambda m: _PDF_ESCAPES.get(m[1])
+            or (bytes([int(m[1], 8) & 0xFF]) if m[1].isdigit() else m[1]),
+            raw[1:-1],
+        )
+    if data.startswith(b"\xfe\xff"):
+        return data[2:].decode("utf-16-be", "replace")
+    return data.decode("latin-1")
+
+
+def extract_pdf_metadata(pdf_path: str | Path | BinaryIO) -> dict[str, str | None]:
+    """
+    Extracts title and author from a PDF's Info dictionary, found by scanning
+    both ends of the file. Info held in compressed object streams is not read.
+    """
+    with _open_with_path(pdf_path) as (f, path):
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(max(0, size - PDF_SCAN_SIZE))
+        data = f.read()
+        if size > PDF_SCAN_SIZE:
+            f.seek(0)
+            data += f.read(PDF_SCAN_SIZE)
+
+    metadata = {"title": None, "author": None, "path": path}
+    for key in ("Title", "Author"):
+        match = re.search(rb"/" + key.encode() + rb"\s*(" + _PDF_STRING + rb")", data)
+        if match:
+            metadata[key.lower()] = _pdf_text(match[1]).strip() or None
+    return metadata
+
+
+# Metadata extractor for each sniffed format
+EXTRACTORS = {
+    "epub": extract_epub_metadata,
+    "fb2": extract_fb2_metadata,
+    "fbz": extract_fbz_metadata,
+    "mobi": extract_mobi_metadata,
+    "azw3": extract_mobi_metadata,
+    "azw": extract_mobi_metadata,
+    "cbz": extract_cbz_metadata,
+    "pdf": extract_pdf_metadata,
+}
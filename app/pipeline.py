@@ -0,0 +1,270 @@
+import queue
+import threading
+import time
+from pathlib import Path
+
+from .addressing import hash_file
+from .blobstore import get_blob_store
+from .formats import BOOK_FORMATS, UnsupportedFormatError
+from .storage import (
+    IngestSession,
+    ScanManifest,
+    _read_metadata,
+    detect_format,
+    iter_files,
+)
+
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of the ingest pipeline: a bounded input queue drained by a pool
+    of worker threads. `func` takes an item and yields zero or more items for
+    the next stage; a full downstream queue blocks the workers (backpressure).
+    """
+
+    def __init__(self, name: str, func, workers: int = 1, queue_size: int = 64):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next = None
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+        self._running = 0
+        self._started = None
+        self._finished = None
+        self._threads = []
+
+    def start(self) -> None:
+        self._running = self.workers
+        self._started = time.perf_counter()
+        self._threads = [
+            threading.Thread(
+                target=self._run, name=f"ingest-{self.name}-{i}", daemon=True
+            )
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def join(self) -> None:
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                break
+            start = time.perf_counter()
+            try:
+                for out in self.func(item):
+                    if self.next is not None:
+                        self.next.queue.put(out)
+            except Exception as e:
+                src = item["src"] if isinstance(item, dict) else item
+                print(f"Failed to store {src}: {e}")
+                with self._lock:
+                    self.failed += 1
+                continue
+            finally:
+                with self._lock:
+                    self.busy_seconds += time.perf_counter() - start
+            with self._lock:
+                self.processed += 1
+
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last:
+            # The last worker out tells every downstream worker to stop
+            self._finished = time.perf_counter()
+            if self.next is not None:
+                for _ in range(self.next.workers):
+                    self.next.queue.put(_DONE)
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            processed, failed, busy = self.processed, self.failed, self.busy_seconds
+        if self._started is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self._finished or time.perf_counter()) - self._started
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize(),
+            "processed": processed,
+            "failed": failed,
+            "busy_seconds": busy,
+            "seconds": elapsed,
+            "throughput": processed / elapsed if elapsed else 0.0,
+        }
+
+
+class IngestPipeline:
+    """
+    Streaming import split into scan, hash, copy, metadata and index stages.
+    Each stage has its own worker count and bounded queue, so a slow disk or a
+    pathological EPUB only occupies the workers of its own stage. The index
+    stage always has a single worker, which is the only writer of the index.
+    The hash stage sniffs each file's format in the same open; files whose
+    format is not in `formats` are dropped there.
+    """
+
+    DEFAULT_WORKERS = {"scan": 1, "hash": 2, "copy": 2, "metadata": 2, "index": 1}
+
+    def __init__(
+        self,
+        workers: dict[str, int] | None = None,
+        queue_size: int = 64,
+        recursive: bool = True,
+        checkpoint_every: int | None = None,
+        incremental: bool = True,
+        storage_mode: str | None = None,
+        formats=BOOK_FORMATS,
+    ):
+        workers = {**self.DEFAULT_WORKERS, **(workers or {})}
+        workers["index"] = 1
+        self.recursive = recursive
+        self.checkpoint_every = checkpoint_every
+        self.incremental = incremental
+        self.storage_mode = storage_mode
+        self.formats = formats
+        self.results = []
+        self.session = None
+        self.manifest = None
+        self._copying = set()
+        self._copying_lock = threading.Lock()
+        self._deferred = []
+
+        self.stages = [
+            Stage("scan", self._scan, workers["scan"], queue_size),
+            Stage("hash", self._hash, workers["hash"], queue_size),
+            Stage("copy", self._copy, workers["copy"], queue_size),
+            Stage("metadata", self._metadata, workers["metadata"], queue_size),
+            Stage("index", self._index, workers["index"], queue_size),
+        ]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next = next_stage
+
+    def _scan(self, folder_path: Path):
+        for book_file, st in iter_files(folder_path, self.recursive):
+            item = {"src": book_file, "stat": st}
+            existing = None
+            if self.manifest is not None:
+                known_hash = self.manifest.lookup(book_file, st)
+                existing = self.session.lookup(known_hash) if known_hash else None
+            if existing is None:
+                existing = self.session.resumed(book_file)
+            if existing is not None:
+                item["entry"] = existing
+            yield item
+
+    def _hash(self, item: dict):
+        if "entry" not in item:
+            with item["src"].open("rb", buffering=0) as f:
+                try:
+                    item["format"] = detect_format(f, item["src"], self.formats)
+                except UnsupportedFormatError:
+                    return
+                item["hash"] = hash_file(f, algorithm=self.session.algorithm)
+        yield item
+
+    def _copy(self, item: dict):
+        if "entry" in item:
+            yield item
+            return
+        file_hash = item["hash"]
+        existing = self.session.lookup(file_hash)
+        with self._copying_lock:
+            duplicate = existing is not None or file_hash in self._copying
+            self._copying.add(file_hash)
+        if duplicate:
+            # Resolved against the index once the first copy is recorded
+            item["duplicate"] = True
+        else:
+            item["stored_path"], item["storage_mode"] = get_blob_store().put(
+                item["src"], file_hash, item["format"], self.session.storage_mode
+            )
+        yield item
+
+    def _metadata(self, item: dict):
+        if "entry" not in item and "duplicate" not in item:
+            item["metadata"] = _read_metadata(item["stored_path"], item["format"])
+        yield item
+
+    def _index(self, item: dict):
+        if "entry" in item:
+            self.results.append(item["entry"])
+            if self.manifest is not None:
+                self.manifest.update(item["src"], item["stat"], item["entry"]["hash"])
+            return
+        if "duplicate" in item:
+            self._deferred.append(item)
+            return
+        entry = {
+            "hash": item["hash"],
+            "stored_path": item["stored_path"],
+            "format": item["format"],
+            "metadata": item["metadata"],
+            "size": item["stat"].st_size,
+            "algorithm": self.session.algorithm,
+        }
+        if item["storage_mode"] is not None:
+            entry["storage_mode"] = item["storage_mode"]
+        self.session.record(entry, item["src"])
+        self.results.append(entry)
+        if self.manifest is not None:
+            self.manifest.update(item["src"], item["stat"], item["hash"])
+        yield from ()
+
+    def start(self, folder_path: str | Path) -> None:
+        # Start all stages and feed the folder to the scan stage.
+        folder_path = Path(folder_path)
+        if not folder_path.exists():
+            raise FileNotFoundError(folder_path)
+        self.results = []
+        self._deferred = []
+        self._copying = set()
+        self.session = IngestSession(
+            self.checkpoint_every, storage_mode=self.storage_mode
+        )
+        self.manifest = ScanManifest() if self.incremental else None
+        for stage in self.stages:
+            stage.start()
+        scan = self.stages[0]
+        scan.queue.put(folder_path)
+        for _ in range(scan.workers):
+            scan.queue.put(_DONE)
+
+    def join(self) -> list[dict[str, object]]:
+        # Wait for every stage to drain, then commit the index.
+        try:
+            for stage in self.stages:
+                stage.join()
+            for item in self._deferred:
+                entry = self.session.lookup(item["hash"])
+                if entry is None:
+                    print(f"Failed to store {item['src']}: original copy failed")
+                    continue
+                self.results.append(entry)
+                if self.manifest is not None:
+                    self.manifest.update(item["src"], item["stat"], item["hash"])
+        finally:
+            self.session.commit()
+            if self.manifest is not None:
+                self.manifest.save()
+            self.session.close()
+        return self.results
+
+    def run(self, folder_path: str | Path) -> list[dict[str, object]]:
+        self.start(folder_path)
+        return self.join()
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        # Per-stage queue depth and throughput; safe to call while running.
+        return {stage.name: stage.stats() for stage in self.stages}
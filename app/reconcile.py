@@ -0,0 +1,113 @@
+import argparse
+
+from .addressing import DIGEST_ALGORITHM, DIGEST_ALGORITHMS
+from .blobstore import (
+    blob_key,
+    blob_size,
+    delete_blob,
+    hash_blob,
+    iter_stored_blobs,
+)
+from .storage import _read_metadata
+from .utils import load_index, save_index
+
+
+def _detect_algorithm(path: str, file_hash: str) -> str | None:
+    # Try the configured algorithm first; orphans are usually recent.
+    algorithms = [DIGEST_ALGORITHM]
+    algorithms += [a for a in DIGEST_ALGORITHMS if a != DIGEST_ALGORITHM]
+    for algorithm in algorithms:
+        if hash_blob(path, algorithm=algorithm) == file_hash:
+            return algorithm
+    return None
+
+
+def reconcile_library(orphans: str = "report", drop_dangling: bool = False) -> dict:
+    """
+    Diffs the blob stores against the index in one pass over each.
+    Loose blobs are listed with os.scandir and packed ones from the pack
+    indexes; both sides become sets of (hash, format) keys, so no per-entry
+    stat calls are made.
+
+    orphans: "report" only lists blobs without an index entry, "adopt" indexes
+    them (after checking which digest algorithm their file name comes from;
+    blobs matching none are left alone), and "delete" removes them. Don't
+    delete while an import is running, as its newest blobs may not be
+    indexed yet.
+    drop_dangling removes index entries whose blob is gone.
+    Entries whose blob exists under another path are repointed.
+    Returns the orphaned paths, dangling hashes and repointed hashes.
+    """
+    if orphans not in ("report", "adopt", "delete"):
+        raise ValueError(f"Unknown orphan action: {orphans}")
+
+    index = load_index()
+    on_disk = {(file_hash, ext): path for file_hash, ext, path in iter_stored_blobs()}
+    indexed = {(entry["hash"], entry["format"]): entry for entry in index}
+
+    orphan_keys = on_disk.keys() - indexed.keys()
+    dangling_keys = indexed.keys() - on_disk.keys()
+    changed = False
+
+    relocated = []
+    for key in indexed.keys() & on_disk.keys():
+        entry = indexed[key]
+        if blob_key(entry["stored_path"]) != blob_key(on_disk[key]):
+            entry["stored_path"] = on_disk[key]
+            relocated.append(key[0])
+            changed = True
+
+    for key in sorted(orphan_keys):
+        path = on_disk[key]
+        if orphans == "adopt":
+            file_hash, ext = key
+            algorithm = _detect_algorithm(path, file_hash)
+            if algorithm is None:
+                print(f"Not adopting {path}: content does not match its name")
+                continue
+            index.append(
+                {
+                    "hash": file_hash,
+                    "stored_path": path,
+                    "format": ext,
+                    "metadata": _read_metadata(path, ext),
+                    "size": blob_size(path),
+                    "algorithm": algorithm,
+                }
+            )
+            changed = True
+        elif orphans == "delete":
+            delete_blob(path)
+
+    if drop_dangling and dangling_keys:
+        index = [
+            entry
+            for entry in index
+            if (entry["hash"], entry["format"]) not in dangling_keys
+        ]
+        changed = True
+
+    if changed:
+        save_index(index)
+
+    return {
+        "orphaned": sorted(on_disk[key] for key in orphan_keys),
+        "dangling": sorted(key[0] for key in dangling_keys),
+        "relocated": sorted(relocated),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconcile blob store and index")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--adopt", action="store_true", help="index orphaned blobs")
+    action.add_argument("--delete", action="store_true", help="delete orphaned blobs")
+    parser.add_argument("--drop-dangling", action="store_true")
+    args = parser.parse_args()
+
+    orphans = "adopt" if args.adopt else "delete" if args.delete else "report"
+    result = reconcile_library(orphans, args.drop_dangling)
+    for status, items in result.items():
+        print(f"{status}: {len(items)}")
+        for item in items:
+            print(f"  {item}")
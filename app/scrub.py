@@ -0,0 +1,148 @@
+import argparse
+import collections
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .addressing import entry_algorithm
+from .blobstore import hash_blob, iter_stored_blobs
+from .storage import DEFAULT_LIBRARY_ROOT
+from .utils import get_index
+
+# One [status, hash] line per checked blob, appended in batches
+SCRUB_CHECKPOINT = DEFAULT_LIBRARY_ROOT / "scrub_checkpoint.jsonl"
+
+
+class RateLimiter:
+    """
+    Caps the combined read throughput of all scrub threads. Each call
+    reserves a slot for `nbytes` and sleeps until that slot comes up.
+    """
+
+    def __init__(self, mb_per_s: float):
+        self.bytes_per_s = mb_per_s * 1024 * 1024
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, nbytes: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + nbytes / self.bytes_per_s
+        if start > now:
+            time.sleep(start - now)
+
+
+def _check_entry(entry: dict, throttle) -> str:
+    # Returns "ok", "corrupt", "missing" or "unreadable" for one index entry.
+    try:
+        file_hash = hash_blob(entry["stored_path"], throttle, entry_algorithm(entry))
+    except FileNotFoundError:
+        return "missing"
+    except OSError as e:
+        # A failing disk (EIO) or something else in the blob's place
+        print(f"Could not read {entry['stored_path']}: {e}")
+        return "unreadable"
+    return "ok" if file_hash == entry["hash"] else "corrupt"
+
+
+def _load_checkpoint(path: Path) -> dict:
+    report = {"ok": [], "corrupt": [], "missing": [], "unreadable": []}
+    if path.exists():
+        with path.open("r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # torn final line from a crash
+                status, file_hash = json.loads(line)
+                report[status].append(file_hash)
+    return report
+
+
+def _save_checkpoint(path: Path, results: list[tuple[str, str]]) -> None:
+    # Appends only the results since the last checkpoint
+    data = "".join(json.dumps(result) + "\n" for result in results)
+    with path.open("a", encoding="utf-8") as f:
+        f.write(data)
+
+
+def verify_library(
+    workers: int | None = None,
+    max_mb_per_s: float | None = None,
+    checkpoint_every: int = 500,
+    resume: bool = True,
+) -> dict[str, list]:
+    """
+    Re-hashes every indexed blob with its entry's algorithm and compares it
+    with the hash in the index.
+    Hashing runs on a thread pool (hashlib releases the GIL), optionally capped
+    at max_mb_per_s across all threads. Progress is checkpointed so an
+    interrupted scrub resumes where it stopped; each checkpoint appends only
+    the results since the last one, so checkpoint I/O stays linear.
+    Returns hashes grouped as "ok", "corrupt", "missing" and "unreadable" (a
+    read error other than a missing file), plus the paths of "orphaned" blobs
+    that have no index entry.
+    """
+    workers = workers or os.cpu_count() or 1
+    throttle = RateLimiter(max_mb_per_s) if max_mb_per_s else None
+    if not resume:
+        SCRUB_CHECKPOINT.unlink(missing_ok=True)
+    report = _load_checkpoint(SCRUB_CHECKPOINT)
+    done = {file_hash for hashes in report.values() for file_hash in hashes}
+
+    index = get_index()
+    todo = (entry for entry in index if entry["hash"] not in done)
+    checked = 0
+    unsaved = []
+    SCRUB_CHECKPOINT.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = collections.deque()
+
+            def collect():
+                nonlocal checked
+                entry, future = pending.popleft()
+                status = future.result()
+                report[status].append(entry["hash"])
+                unsaved.append((status, entry["hash"]))
+                checked += 1
+                if checked % checkpoint_every == 0:
+                    _save_checkpoint(SCRUB_CHECKPOINT, unsaved)
+                    unsaved.clear()
+
+            for entry in todo:
+                pending.append((entry, pool.submit(_check_entry, entry, throttle)))
+                if len(pending) >= workers * 4:
+                    collect()
+            while pending:
+                collect()
+    finally:
+        # Keep what was checked before an error or Ctrl-C for the next run
+        if unsaved:
+            _save_checkpoint(SCRUB_CHECKPOINT, unsaved)
+
+    indexed = {(entry["hash"], entry["format"]) for entry in index}
+    report["orphaned"] = [
+        path
+        for file_hash, ext, path in iter_stored_blobs()
+        if (file_hash, ext) not in indexed
+    ]
+    SCRUB_CHECKPOINT.unlink(missing_ok=True)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify library blobs")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-mb-per-s", type=float, default=None)
+    parser.add_argument("--restart", action="store_true", help="ignore checkpoint")
+    args = parser.parse_args()
+
+    result = verify_library(args.workers, args.max_mb_per_s, resume=not args.restart)
+    for status in ("ok", "corrupt", "missing", "unreadable", "orphaned"):
+        print(f"{status}: {len(result[status])}")
+    for status in ("corrupt", "missing", "unreadable", "orphaned"):
+        for item in result[status]:
+            print(f"  {status}: {item}")
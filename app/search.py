@@ -1,23 +1,36 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Union
 
-from .utils import load_index, save_index
+from .database import LibraryDB, get_db
+from .snapshot import IndexSnapshot, open_snapshot
+from .utils import INDEX_BACKEND, get_index
 
 
-def strict_search_library(index: List[Dict], query: str) -> List[Dict]:
-    """Simple strict search: matches query as substring in title or author."""
+def strict_search_library(
+    index: Union[List[Dict], LibraryDB, IndexSnapshot], query: str
+) -> List[Dict]:
+    """
+    Simple strict search: matches query as substring in title or author.
+    Given a LibraryDB, the search runs in SQLite.
+    """
+    if isinstance(index, LibraryDB):
+        return index.search(query)
     query = query.lower()
-    return [
-        book
-        for book in index
-        if (
-            book.get("metadata", {}).get("title")
-            and query in book["metadata"]["title"].lower()
-        )
-        or (
-            book.get("metadata", {}).get("author")
-            and query in book["metadata"]["author"].lower()
+
+    def matches(book: Dict) -> bool:
+        return bool(
+            (
+                book.get("metadata", {}).get("title")
+                and query in book["metadata"]["title"].lower()
+            )
+            or (
+                book.get("metadata", {}).get("author")
+                and query in book["metadata"]["author"].lower()
+            )
         )
-    ]
+
+    if isinstance(index, IndexSnapshot):
+        return index.select(matches)
+    return [book for book in index if matches(book)]
 
 
 def relaxed_search_library(haystack: str, needle: str) -> bool:
@@ -27,14 +40,44 @@ def relaxed_search_library(haystack: str, needle: str) -> bool:
     return all(word in haystack for word in words)
 
 
+def ranked_search_library(
+    index: Union[List[Dict], LibraryDB, IndexSnapshot],
+    query: str,
+    limit: Optional[int] = 50,
+) -> List[Dict]:
+    """
+    Multi-word search over title and author, best matches first.
+    Given a LibraryDB it runs as an FTS5 prefix query that also covers
+    Hardcover fields; a list index falls back to relaxed matching in order.
+    """
+    if isinstance(index, LibraryDB):
+        return index.full_text_search(query, limit)
+
+    def matches(book: Dict) -> bool:
+        md = book.get("metadata", {})
+        haystack = f"{md.get('title') or ''} {md.get('author') or ''}"
+        return relaxed_search_library(haystack, query)
+
+    if isinstance(index, IndexSnapshot):
+        results = index.select(matches)
+    else:
+        results = [book for book in index if matches(book)]
+    return results[:limit] if limit is not None else results
+
+
 def filter_library(
-    index: List[Dict],
+    index: Union[List[Dict], LibraryDB, IndexSnapshot],
     title: Optional[str] = None,
     author: Optional[str] = None,
     fmt: Optional[str] = None,
     mode: str = "strict",  # "strict" or "relaxed"
 ) -> List[Dict]:
-    """Return books that match filters. Title/author match using OR logic."""
+    """
+    Return books that match filters. Title/author match using OR logic.
+    Given a LibraryDB, the filter runs in SQLite.
+    """
+    if isinstance(index, LibraryDB):
+        return index.filter(title, author, fmt, mode)
 
     def cmp(haystack: str, needle: str) -> bool:
         if mode == "strict":
@@ -42,8 +85,7 @@ def filter_library(
         else:
             return relaxed_search_library(haystack, needle)
 
-    results = []
-    for book in index:
+    def keep(book: Dict) -> bool:
         md = book.get("metadata", {})
 
         # Check title and author using OR
@@ -52,14 +94,16 @@ def filter_library(
             matches = True
         if author and md.get("author") and cmp(md["author"], author):
             matches = True
-        if fmt and md.get("format") and fmt.lower() != md["format"].lower():
-            continue  # format must match exactly
+        book_fmt = book.get("format") or md.get("format")
+        if fmt and book_fmt and fmt.lower() != book_fmt.lower():
+            return False  # format must match exactly
 
         # Include if it matched any query or if no query provided
-        if matches or (not title and not author):
-            results.append(book)
+        return matches or (not title and not author)
 
-    return results
+    if isinstance(index, IndexSnapshot):
+        return index.select(keep)
+    return [book for book in index if keep(book)]
 
 
 def display_library(index: List[Dict]) -> None:
@@ -75,7 +119,11 @@ def display_library(index: List[Dict]) -> None:
 
 
 if __name__ == "__main__":
-    index = load_index()
+    if INDEX_BACKEND == "sqlite":
+        index = get_db()
+    else:
+        # The mmap'd binary snapshot when it's current, else the parsed JSON
+        index = open_snapshot() or get_index()
 
     # Example usage: filter by title, author, and format
     results = filter_library(index, title="dune", author="herbert", mode="relaxed")
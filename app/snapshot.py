@@ -0,0 +1,344 @@
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from pathlib import Path
+
+from .utils import INDEX_FILE, INDEX_LOG
+
+INDEX_SNAPSHOT = INDEX_FILE.with_suffix(".bin")
+MAGIC = b"LIBIDX1\0"
+# Magic, entry count, size and mtime_ns of the JSON snapshot it was written
+# with, hash column width; then an (offset, length) pair per section
+_HEADER = struct.Struct("<8sQQqI4x")
+_SECTIONS = (
+    "formats",  # JSON list of the format names the format codes index
+    "hashes",  # raw digest bytes, zero-padded to the hash column width
+    "hash_lengths",
+    "format_codes",
+    "flags",
+    "order",  # row numbers sorted by hash, for lookups
+    "title_offsets",
+    "titles",
+    "author_offsets",
+    "authors",
+    "path_offsets",
+    "paths",
+    "rest_offsets",
+    "rest",  # the remaining fields of each entry as JSON
+)
+_DIRECTORY = struct.Struct(f"<{2 * len(_SECTIONS)}Q")
+# Which fields of an entry are held in columns rather than in its rest JSON
+_TITLE, _AUTHOR, _FORMAT, _PATH = 1, 2, 4, 8
+
+
+def _string_table(values: list[str]) -> tuple[bytes, bytes]:
+    # UTF-8 strings back to back, and the N + 1 offsets that delimit them
+    offsets = array("Q", [0])
+    data = bytearray()
+    for value in values:
+        data += value.encode("utf-8")
+        offsets.append(len(data))
+    return offsets.tobytes(), bytes(data)
+
+
+def _columns(entries: list[dict]) -> tuple[int, dict[str, bytes]]:
+    digests, titles, authors, paths, rests = [], [], [], [], []
+    formats = {}
+    codes, flags = array("B"), array("B")
+    for entry in entries:
+        rest = dict(entry)
+        digests.append(bytes.fromhex(rest.pop("hash")))
+        row_flags = 0
+        if isinstance(rest.get("format"), str):
+            row_flags |= _FORMAT
+            code = formats.setdefault(rest.pop("format"), len(formats))
+            if code > 255:
+                raise ValueError("more than 256 formats")
+            codes.append(code)
+        else:
+            codes.append(0)
+        if isinstance(rest.get("stored_path"), str):
+            row_flags |= _PATH
+            paths.append(rest.pop("stored_path"))
+        else:
+            paths.append("")
+        metadata = rest.get("metadata")
+        metadata = dict(metadata) if isinstance(metadata, dict) else {}
+        for key, bit, column in (
+            ("title", _TITLE, titles),
+            ("author", _AUTHOR, authors),
+        ):
+            if isinstance(metadata.get(key), str):
+                row_flags |= bit
+                column.append(metadata.pop(key))
+            else:
+                column.append("")
+        if row_flags & (_TITLE | _AUTHOR):
+            rest["metadata"] = metadata
+        flags.append(row_flags)
+        rests.append(json.dumps(rest, ensure_ascii=False))
+
+    width = max(map(len, digests), default=0)
+    sections = {
+        "formats": json.dumps(list(formats)).encode("utf-8"),
+        "hashes": b"".join(digest.ljust(width, b"\0") for digest in digests),
+        "hash_lengths": array("B", map(len, digests)).tobytes(),
+        "format_codes": codes.tobytes(),
+        "flags": flags.tobytes(),
+        "order": array(
+            "I", sorted(range(len(digests)), key=digests.__getitem__)
+        ).tobytes(),
+    }
+    for offsets, table, values in (
+        ("title_offsets", "titles", titles),
+        ("author_offsets", "authors", authors),
+        ("path_offsets", "paths", paths),
+        ("rest_offsets", "rest", rests),
+    ):
+        sections[offsets], sections[table] = _string_table(values)
+    return width, sections
+
+
+def write_snapshot(
+    entries: list[dict], path: str | Path = INDEX_SNAPSHOT, source: Path = INDEX_FILE
+) -> None:
+    """
+    Writes the binary columnar snapshot of `entries`, stamped with the size
+    and mtime of the JSON snapshot (`source`) holding the same entries so a
+    stale one is never opened. Called by the JSON index whenever it writes a
+    snapshot; entries it can't encode (a non-hex hash) leave no binary
+    snapshot, and readers fall back to the JSON.
+    """
+    path = Path(path)
+    try:
+        width, sections = _columns(entries)
+    except ValueError as e:
+        print(f"Not writing {path}: {e}")
+        path.unlink(missing_ok=True)
+        return
+
+    stat = source.stat()
+    offset = _HEADER.size + _DIRECTORY.size
+    directory, parts = [], []
+    for name in _SECTIONS:
+        pad = -offset % 8  # keep the offset and hash columns aligned
+        parts += [b"\0" * pad, sections[name]]
+        offset += pad
+        directory += [offset, len(sections[name])]
+        offset += len(sections[name])
+    header = _HEADER.pack(MAGIC, len(entries), stat.st_size, stat.st_mtime_ns, width)
+    tmp_path = path.with_suffix(".bin.tmp")
+    with tmp_path.open("wb") as f:
+        f.write(header + _DIRECTORY.pack(*directory))
+        f.writelines(parts)
+    os.replace(tmp_path, path)
+
+
+class IndexSnapshot:
+    """
+    A read-only view of the library index over a memory-mapped binary
+    snapshot. Opening it parses nothing: columns are sliced out of the
+    mapping, so pages are only read when a row is touched. Searches test
+    the title, author and format columns and only build the entries that
+    match (see select).
+
+    `changes` maps hashes to the entries the index log has set since the
+    snapshot was written (None for deleted ones); they are applied the way
+    load_index replays the log, updates in place and new entries last.
+    """
+
+    def __init__(self, path: str | Path = INDEX_SNAPSHOT, changes: dict | None = None):
+        self.path = Path(path)
+        with self.path.open("rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, self._count, size, mtime_ns, self._width = _HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not an index snapshot")
+        self.source_stamp = (size, mtime_ns)
+        bounds = _DIRECTORY.unpack_from(view, _HEADER.size)
+        sections = {
+            name: view[start : start + length]
+            for name, start, length in zip(_SECTIONS, bounds[::2], bounds[1::2])
+        }
+        self._formats = json.loads(bytes(sections["formats"]))
+        self._hashes = sections["hashes"]
+        self._hash_lengths = sections["hash_lengths"]
+        self._format_codes = sections["format_codes"]
+        self._flags = sections["flags"]
+        self._order = sections["order"].cast("I")
+        self._tables = {
+            name: (sections[f"{name}_offsets"].cast("Q"), sections[table])
+            for name, table in (
+                ("title", "titles"),
+                ("author", "authors"),
+                ("path", "paths"),
+                ("rest", "rest"),
+            )
+        }
+
+        self._overrides, self._added = {}, []
+        for file_hash, entry in (changes or {}).items():
+            row = self._row(file_hash)
+            if row is not None:
+                self._overrides[row] = entry
+            elif entry is not None:
+                self._added.append(entry)
+
+    def _digest(self, row: int) -> bytes:
+        start = row * self._width
+        return bytes(self._hashes[start : start + self._hash_lengths[row]])
+
+    def _row(self, file_hash: str) -> int | None:
+        # Binary search of the hash column through the sorted row order
+        try:
+            digest = bytes.fromhex(file_hash)
+        except ValueError:
+            return None
+        i = bisect.bisect_left(self._order, digest, key=self._digest)
+        if i < self._count and self._digest(self._order[i]) == digest:
+            return self._order[i]
+        return None
+
+    def _string(self, table: str, row: int) -> str:
+        offsets, data = self._tables[table]
+        return str(data[offsets[row] : offsets[row + 1]], "utf-8")
+
+    def _column(self, table: str, bit: int) -> list[str | None]:
+        # A whole string column decoded in one pass, None where it's unset
+        offsets, data = self._tables[table]
+        raw, bounds = bytes(data), offsets.tolist()
+        return [
+            raw[start:end].decode("utf-8") if flags & bit else None
+            for start, end, flags in zip(bounds, bounds[1:], bytes(self._flags))
+        ]
+
+    def _stubs(self):
+        # Just the column fields of each row, enough for search predicates
+        formats = [
+            self._formats[code] if flags & _FORMAT else None
+            for code, flags in zip(bytes(self._format_codes), bytes(self._flags))
+        ]
+        titles = self._column("title", _TITLE)
+        authors = self._column("author", _AUTHOR)
+        for fmt, title, author in zip(formats, titles, authors):
+            yield {"format": fmt, "metadata": {"title": title, "author": author}}
+
+    def _entry(self, row: int) -> dict:
+        flags = self._flags[row]
+        entry = {"hash": self._digest(row).hex()}
+        if flags & _PATH:
+            entry["stored_path"] = self._string("path", row)
+        if flags & _FORMAT:
+            entry["format"] = self._formats[self._format_codes[row]]
+        entry.update(json.loads(self._string("rest", row)))
+        if flags & (_TITLE | _AUTHOR):
+            metadata = {}
+            if flags & _TITLE:
+                metadata["title"] = self._string("title", row)
+            if flags & _AUTHOR:
+                metadata["author"] = self._string("author", row)
+            entry["metadata"] = {**metadata, **entry["metadata"]}
+        return entry
+
+    def __len__(self) -> int:
+        deleted = sum(entry is None for entry in self._overrides.values())
+        return self._count - deleted + len(self._added)
+
+    def __iter__(self):
+        for row in range(self._count):
+            if row not in self._overrides:
+                yield self._entry(row)
+            elif self._overrides[row] is not None:
+                yield self._overrides[row]
+        yield from self._added
+
+    def get(self, file_hash: str) -> dict | None:
+        row = self._row(file_hash)
+        if row is None:
+            return next((e for e in self._added if e["hash"] == file_hash), None)
+        if row in self._overrides:
+            return self._overrides[row]
+        return self._entry(row)
+
+    def entries(self) -> list[dict]:
+        return list(self)
+
+    def select(self, predicate) -> list[dict]:
+        """
+        Entries for which predicate(entry) is true, in index order. The
+        predicate sees only format, title and author for unchanged rows, so
+        whole entries are only built for the matches.
+        """
+        results = []
+        for row, stub in enumerate(self._stubs()):
+            if row in self._overrides:
+                entry = self._overrides[row]
+                if entry is not None and predicate(entry):
+                    results.append(entry)
+            elif predicate(stub):
+                results.append(self._entry(row))
+        results += [entry for entry in self._added if predicate(entry)]
+        return results
+
+
+def _log_changes(log) -> dict:
+    # Hashes set or deleted (None) by the complete records of the index log
+    changes = {}
+    for line in log:
+        if not line.endswith(b"\n"):
+            break  # torn final record from a crash
+        record = json.loads(line)
+        changes[record["hash"]] = (
+            record.get("entry") if record["op"] != "delete" else None
+        )
+    return changes
+
+
+def open_snapshot(path: str | Path = INDEX_SNAPSHOT) -> IndexSnapshot | None:
+    """
+    The current index as an IndexSnapshot, or None if there's no binary
+    snapshot matching the JSON one (load_index is the fallback). Pending
+    index log records are read under the same shared lock as load_index.
+    """
+
+    def current(changes: dict) -> IndexSnapshot | None:
+        try:
+            snapshot = IndexSnapshot(path, changes)
+            stat = INDEX_FILE.stat()
+        except (OSError, ValueError):
+            return None
+        if snapshot.source_stamp != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return snapshot
+
+    if not INDEX_LOG.exists():
+        return current({})
+    with INDEX_LOG.open("rb") as log:
+        fcntl.flock(log, fcntl.LOCK_SH)
+        return current(_log_changes(log))
+
+
+if __name__ == "__main__":
+    # Usage: python -m app.snapshot build
+    #        python -m app.snapshot search <words ...>
+    if sys.argv[1:2] == ["build"]:
+        from .utils import compact_index
+
+        print(f"Wrote {INDEX_SNAPSHOT} with {compact_index()} entries")
+    elif sys.argv[1:2] == ["search"]:
+        from .search import display_library, strict_search_library
+
+        snapshot = open_snapshot()
+        if snapshot is None:
+            print(f"No current snapshot at {INDEX_SNAPSHOT}; run build first")
+        else:
+            display_library(strict_search_library(snapshot, " ".join(sys.argv[2:])))
+    else:
+        print("Usage: python -m app.snapshot build")
+        print("       python -m app.snapshot search <words ...>")
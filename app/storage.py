@@ -1,89 +1,1023 @@
+import collections
+import contextlib
+import fcntl
 import hashlib
+import io
 import json
 import os
-import shutil
+import secrets
+import stat
+import tarfile
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
-from .metadata import extract_epub_metadata
-from .utils import load_index, save_index
+from .addressing import (
+    DIGEST_ALGORITHM,
+    DIGEST_ALGORITHMS,
+    _prune_shards,
+    blob_path,
+    compute_hash,
+    entry_algorithm,
+    hash_file,
+)
+from .blobstore import (
+    blob_exists,
+    blob_scheme,
+    blob_size,
+    delete_blob,
+    get_blob_store,
+    open_blob,
+    resolve,
+)
+from .formats import (
+    BOOK_FORMATS,
+    SNIFF_SIZE,
+    UnsupportedFormatError,
+    sniff_file,
+    sniff_format,
+)
+from .metadata import EXTRACTORS
+from .database import get_db
+from .utils import (
+    INDEX_BACKEND,
+    append_index_log,
+    compact_index,
+    load_index,
+    save_index,
+)
 
-CHUNK_SIZE = 8192
+PARTIAL_HASH_SIZE = 64 * 1024
+# Files in flight per pool worker when analysing in parallel
+ANALYSE_WINDOW = 4
+# Archive members up to this size are read into memory; larger ones are
+# streamed into the store and their metadata read back from the blob
+ARCHIVE_MEMORY_MAX = 64 * 1024 * 1024
 DEFAULT_LIBRARY_ROOT = Path(os.environ.get("LIBRARY_ROOT", "library_files"))
 INDEX_FILE = DEFAULT_LIBRARY_ROOT / "library_index.json"
+MANIFEST_FILE = DEFAULT_LIBRARY_ROOT / "scan_manifest.json"
+# Each session journals to its own ingest_journal-<pid>-<token>.jsonl,
+# flocked while the session is live
+JOURNAL_DIR = DEFAULT_LIBRARY_ROOT
+JOURNAL_GLOB = "ingest_journal*.jsonl"
+# One of "copy", "reflink", "hardlink", "copy_file_range" or "auto"
+STORAGE_MODE = os.environ.get("LIBRARY_STORAGE_MODE", "copy")
 
 
-def compute_hash(path: Path | str) -> str:
-    path = Path(path)  # ensure Path object
-    hasher = hashlib.sha256()
-    with path.open("rb") as f:
-        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+def compute_partial_hash(path: Path | str, size: int | None = None) -> str:
+    # Hash the first and last PARTIAL_HASH_SIZE bytes (the whole file if smaller).
+    with Path(path).open("rb") as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        return _partial_hash(f, size)
 
 
-def store_file(src_path: str | Path) -> dict[str, object]:
-    # Store a file in the library and return its hash as filename.
-    src = Path(src_path)
-    file_hash = compute_hash(src)
-
-    ext = src.suffix.lower().lstrip(".")
-    if not ext:
-        raise ValueError("File has no extension")
+def _partial_hash(f, size: int) -> str:
+    hasher = hashlib.sha256()
+    if size <= 2 * PARTIAL_HASH_SIZE:
+        hasher.update(f.read())
+    else:
+        hasher.update(f.read(PARTIAL_HASH_SIZE))
+        f.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+        hasher.update(f.read(PARTIAL_HASH_SIZE))
+    return hasher.hexdigest()
 
-    dest_dir = DEFAULT_LIBRARY_ROOT / ext
-    dest_dir.mkdir(parents=True, exist_ok=True)
 
-    dest_path = dest_dir / f"{file_hash}.{ext}"
+def detect_format(f, src: Path, formats=None) -> str:
+    """
+    Format of an open file from its magic bytes, falling back to the file
+    extension for formats the sniffer doesn't know. Raises
+    UnsupportedFormatError if there is neither, or the format is not in
+    `formats` (any format is accepted when it is None).
+    """
+    fmt = sniff_file(f) or src.suffix.lower().lstrip(".")
+    if not fmt:
+        raise UnsupportedFormatError(f"Unknown file format: {src}")
+    if formats is not None and fmt not in formats:
+        raise UnsupportedFormatError(f"Not an accepted format ({fmt}): {src}")
+    return fmt
 
-    if not dest_path.exists():
-        shutil.copy2(src, dest_path)
 
+def _read_metadata(
+    stored_path: str | Path, ext: str, source=None
+) -> dict[str, str | None]:
+    # Reads a blob through its store (a plain path is read as a file), or
+    # `source`, an open file with the same content, when given.
     metadata = {}
-    if ext == "epub":
+    extractor = EXTRACTORS.get(ext)
+    if extractor is not None:
         try:
-            metadata = extract_epub_metadata(dest_path)
+            if source is None:
+                opened = open_blob(stored_path)
+            else:
+                source.seek(0)
+                opened = contextlib.nullcontext(source)
+            with opened as f:
+                metadata = extractor(f)
+            metadata["path"] = str(stored_path)
         except Exception as e:
             # On failure return empty metadata
             metadata = {"title": None, "author": None}
-    index = load_index()
-    if not any(entry["hash"] == file_hash for entry in index):
-        index.append(
-            {
-                "hash": file_hash,
-                "stored_path": str(dest_path),
-                "format": ext,
-                "metadata": metadata,
-            }
+    return metadata
+
+
+def _analyse_file(
+    src: Path,
+    single_pass: bool = False,
+    with_metadata: bool = True,
+    algorithm: str | None = None,
+    formats=None,
+) -> dict[str, object]:
+    """
+    Identifies a file's format and hashes it, then optionally reads its
+    metadata with the extractor for that format.
+    In single-pass mode the file is copied into the store while it is hashed.
+    Sniffing and hashing (or copying) share one open of the source.
+    """
+    algorithm = algorithm or DIGEST_ALGORITHM
+    with src.open("rb", buffering=0) as f:
+        ext = detect_format(f, src, formats)
+        size = os.fstat(f.fileno()).st_size
+        analysis = {"format": ext, "size": size, "algorithm": algorithm}
+        if single_pass:
+            file_hash, stored_path, mode = get_blob_store().put_stream(
+                f, ext, algorithm
+            )
+            analysis["hash"] = file_hash
+            analysis["stored_path"] = stored_path
+            analysis["storage_mode"] = mode
+        else:
+            analysis["hash"] = hash_file(f, algorithm=algorithm)
+    if with_metadata:
+        analysis["metadata"] = _read_metadata(analysis.get("stored_path", src), ext)
+    return analysis
+
+
+def _analyse_worker(
+    src: Path,
+    single_pass: bool,
+    with_metadata: bool = True,
+    algorithm: str | None = None,
+    formats=None,
+):
+    # Pool entry point: errors are returned so one bad file doesn't end the map.
+    try:
+        return (
+            _analyse_file(src, single_pass, with_metadata, algorithm, formats),
+            None,
         )
-    save_index(index)
+    except Exception as e:
+        return None, e
 
-    return {
-        "hash": file_hash,
-        "stored_path": str(dest_path),
-        "format": ext,
-        "metadata": metadata,
-    }
 
+def iter_analysed(
+    paths,
+    workers: int = 1,
+    single_pass: bool = False,
+    algorithm: str | None = None,
+    formats=None,
+    with_metadata: bool | None = None,
+):
+    """
+    Yields (path, analysis, error) for each path, in input order.
+    With workers > 1 hashing and metadata extraction run in a process pool.
+    Paths are consumed lazily and at most a few per worker are in flight.
+    Without a pool, metadata is left for IngestSession.add to read, so that
+    it is only parsed for files that turn out to be new; pass with_metadata
+    to extract it (or not) either way.
+    A (path, result) pair in paths is not analysed: it is yielded as
+    (path, result, None) in its place in the order.
+    """
+    if workers <= 1:
+        with_metadata = bool(with_metadata)
+        for path in paths:
+            if isinstance(path, tuple):
+                yield (*path, None)
+                continue
+            path = Path(path)
+            yield (
+                path,
+                *_analyse_worker(path, single_pass, with_metadata, algorithm, formats),
+            )
+        return
+    if with_metadata is None:
+        with_metadata = True
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        try:
+            for path in paths:
+                if isinstance(path, tuple):
+                    path, result = path
+                    future = Future()
+                    future.set_result((result, None))
+                else:
+                    path = Path(path)
+                    future = pool.submit(
+                        _analyse_worker,
+                        path,
+                        single_pass,
+                        with_metadata,
+                        algorithm,
+                        formats,
+                    )
+                pending.append((path, future))
+                if len(pending) >= workers * ANALYSE_WINDOW:
+                    path, future = pending.popleft()
+                    yield (path, *future.result())
+            while pending:
+                path, future = pending.popleft()
+                yield (path, *future.result())
+        finally:
+            for _, future in pending:
+                future.cancel()
 
-def import_folder(
-    folder_path: str | Path, recursive: bool = True
+
+def iter_files(
+    folder_path: str | Path, recursive: bool = True, suffix: str | None = None
+):
+    """
+    Walks a folder with os.scandir and yields (path, stat) for every regular
+    file, or only those whose name ends with suffix (case-insensitive).
+    Formats are told apart by content later, so by default every file is
+    yielded. Directory symlinks are not followed.
+    """
+    stack = [os.fspath(folder_path)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = list(it)
+        except OSError as e:
+            print(f"Failed to scan {e.filename}: {e}")
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        stack.append(entry.path)
+                elif suffix is None or entry.name.lower().endswith(suffix):
+                    st = entry.stat()
+                    if stat.S_ISREG(st.st_mode):
+                        yield Path(entry.path), st
+            except OSError as e:
+                print(f"Failed to scan {entry.path}: {e}")
+
+
+class ScanManifest:
+    """
+    Remembers the hash of every imported source file, keyed by its path and
+    (dev, inode, size, mtime_ns), so unchanged files can skip hashing and
+    metadata extraction on the next import.
+    """
+
+    def __init__(self, path: str | Path = MANIFEST_FILE):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            with self.path.open("r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        self._dirty = False
+
+    @staticmethod
+    def _key(st: os.stat_result) -> list[int]:
+        return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def lookup(self, path: str | Path, st: os.stat_result) -> str | None:
+        # Return the known hash of a file if it is unchanged since last seen.
+        known = self.entries.get(os.path.abspath(path))
+        if known is not None and known[:4] == self._key(st):
+            return known[4]
+        return None
+
+    def update(self, path: str | Path, st: os.stat_result, file_hash: str) -> None:
+        self.entries[os.path.abspath(path)] = [*self._key(st), file_hash]
+        self._dirty = True
+
+    def save(self) -> None:
+        # Write the manifest atomically so a crash never leaves half a file.
+        if not self._dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(self.entries, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+class IngestSession:
+    """
+    Bulk ingest transaction over the library index.
+    Loads the index once, dedups against an in-memory hash table and
+    on commit (or every `checkpoint_every` new entries) appends the entries
+    it added or changed to the index log (see append_index_log).
+    With the SQLite backend nothing is loaded up front: hashes and sizes are
+    looked up in the database, and commit upserts only the entries this
+    session added or changed (`index` then holds just the session's entries).
+    With `single_pass` each file is hashed while it is copied into the store,
+    otherwise new blobs are placed with `storage_mode` (see place_blob).
+
+    With `prefilter`, files are first checked against known blobs by size and
+    then by a partial hash. Files that cannot be duplicates are streamed into
+    the store in one read; likely duplicates are only hashed, never written.
+
+    With `journal`, every stored file is appended to the session's own
+    journal in JOURNAL_DIR as it completes, locked while the session lives.
+    A session started after a crash replays the journals no live session
+    holds into the index, and resumed() lets an import skip the files
+    already done. A session only ever removes its own journal (and the
+    ones it replayed), once its index changes are committed.
+
+    New files are addressed with `algorithm` (DIGEST_ALGORITHM by default).
+    Blobs addressed with another algorithm stay valid, and a likely duplicate
+    of one is also hashed with that blob's algorithm before being copied.
+
+    A file's format is sniffed from its content. With `formats`, files in
+    any other format raise UnsupportedFormatError instead of being stored.
+    """
+
+    def __init__(
+        self,
+        checkpoint_every: int | None = None,
+        single_pass: bool = False,
+        storage_mode: str | None = None,
+        prefilter: bool = True,
+        journal: bool = True,
+        algorithm: str | None = None,
+        formats=None,
+    ):
+        self.db = get_db() if INDEX_BACKEND == "sqlite" else None
+        self.checkpoint_every = checkpoint_every
+        self.single_pass = single_pass
+        self.storage_mode = storage_mode or STORAGE_MODE
+        self.prefilter = prefilter
+        self.formats = formats
+        self.algorithm = algorithm or DIGEST_ALGORITHM
+        if self.algorithm not in DIGEST_ALGORITHMS:
+            raise ValueError(f"Unknown digest algorithm: {self.algorithm}")
+        if self.db is None:
+            self.index = load_index()
+            self._by_hash = {entry["hash"]: entry for entry in self.index}
+            algorithms = {entry_algorithm(entry) for entry in self.index}
+        else:
+            self.index = []
+            self._by_hash = {}  # entries looked up so far
+            algorithms = self.db.algorithms()
+        self._other_algorithms = algorithms - {self.algorithm}
+        self._by_size = None
+        self._changed = {}
+        self._added = set()
+        self._pending = 0
+        self.journal_path = None
+        self._journal = None
+        self._resumed = {}
+        self._replayed = []  # open, locked journals of crashed sessions
+        if journal:
+            token = f"{os.getpid()}-{secrets.token_hex(4)}"
+            self.journal_path = JOURNAL_DIR / f"ingest_journal-{token}.jsonl"
+            for path in sorted(JOURNAL_DIR.glob(JOURNAL_GLOB)):
+                self._replay_journal(path)
+
+    def __enter__(self) -> "IngestSession":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # Blobs already copied are kept, so record them even on failure
+        self.close()
+
+    def _replay_journal(self, path: Path) -> None:
+        # Fold entries from an interrupted session back into the index.
+        f = path.open("r", encoding="utf-8")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.fstat(f.fileno()).st_ino != path.stat().st_ino:
+                raise FileNotFoundError(path)  # removed since we opened it
+        except OSError:
+            f.close()  # a live session's journal, or already replayed
+            return
+        self._replayed.append((path, f))
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break  # torn final line from the crash
+            entry = record["entry"]
+            self._resumed[record["source"]] = entry["hash"]
+            if self._get(entry["hash"]) is None:
+                self._add(entry)
+                self._pending += 1
+
+    def _journal_write(self, src: Path, entry: dict[str, object]) -> None:
+        if self.journal_path is None:
+            return
+        if self._journal is None:
+            # Locked under a name other sessions don't look at, then renamed,
+            # so no one can take it for a crashed session's journal
+            self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.journal_path.with_suffix(".tmp")
+            self._journal = tmp_path.open("a", encoding="utf-8")
+            fcntl.flock(self._journal, fcntl.LOCK_EX)
+            os.replace(tmp_path, self.journal_path)
+        record = {"source": os.path.abspath(src), "entry": entry}
+        self._journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._journal.flush()
+
+    def resumed(self, src_path: str | Path) -> dict[str, object] | None:
+        # Return the entry for a file an interrupted session already stored.
+        file_hash = self._resumed.get(os.path.abspath(src_path))
+        return self.lookup(file_hash) if file_hash else None
+
+    def _get(self, file_hash: str) -> dict[str, object] | None:
+        entry = self._by_hash.get(file_hash)
+        if entry is None and self.db is not None:
+            entry = self.db.get(file_hash)
+            if entry is not None:
+                self._by_hash[file_hash] = entry
+        return entry
+
+    def _add(self, entry: dict[str, object]) -> None:
+        self.index.append(entry)
+        self._by_hash[entry["hash"]] = entry
+        self._changed[entry["hash"]] = entry
+        self._added.add(entry["hash"])
+        if self._by_size is not None:
+            self._index_size(entry)
+
+    def __contains__(self, file_hash: str) -> bool:
+        return self._get(file_hash) is not None
+
+    def lookup(self, file_hash: str) -> dict[str, object] | None:
+        # Return the index entry for a hash if its blob is still stored.
+        existing = self._get(file_hash)
+        if existing is not None and blob_exists(existing["stored_path"]):
+            return existing
+        return None
+
+    def _index_size(self, entry: dict[str, object]) -> None:
+        size = entry.get("size")
+        if size is None:
+            # Entries from before sizes were recorded: stat the blob once
+            try:
+                size = entry["size"] = blob_size(entry["stored_path"])
+                self._changed.setdefault(entry["hash"], entry)
+            except OSError:
+                return
+        self._by_size.setdefault(size, []).append(entry)
+
+    def is_new(self, src: Path) -> bool:
+        # True when no known blob can have the same content as src.
+        return not self.candidates(src)
+
+    def candidates(self, src: Path) -> list[dict[str, object]]:
+        """
+        Returns the index entries that may have the same content as src.
+        Checks file size first, then the partial hash of size-matched blobs.
+        """
+        if self._by_size is None:
+            self._by_size = {}
+            for entry in self.index:
+                self._index_size(entry)
+
+        size = src.stat().st_size
+        sized = self._by_size.get(size, [])
+        if self.db is not None:
+            # Committed session entries are in both
+            seen = {entry["hash"] for entry in sized}
+            sized = sized + [
+                self._by_hash.setdefault(entry["hash"], entry)
+                for entry in self.db.by_size(size)
+                if entry["hash"] not in seen
+            ]
+        if not sized:
+            return []
+
+        partial_hash = compute_partial_hash(src, size)
+        matches = []
+        for entry in sized:
+            if "partial_hash" not in entry:
+                try:
+                    with open_blob(entry["stored_path"]) as f:
+                        entry["partial_hash"] = _partial_hash(f, size)
+                    self._changed.setdefault(entry["hash"], entry)
+                except OSError:
+                    continue
+            if entry["partial_hash"] == partial_hash:
+                matches.append(entry)
+        return matches
+
+    def _match_other_algorithms(
+        self, src: Path, candidates: list[dict[str, object]]
+    ) -> dict[str, object] | None:
+        # Hash src the way each candidate was addressed and compare.
+        digests = {}
+        for entry in candidates:
+            algorithm = entry_algorithm(entry)
+            if algorithm == self.algorithm:
+                continue
+            if algorithm not in digests:
+                digests[algorithm] = compute_hash(src, algorithm=algorithm)
+            if digests[algorithm] == entry["hash"]:
+                return self.lookup(entry["hash"])
+        return None
+
+    def add(
+        self, src_path: str | Path, analysis: dict[str, object] | None = None
+    ) -> dict[str, object]:
+        """
+        Stores a file in the library and returns its index entry.
+        `analysis` is a precomputed result of _analyse_file, e.g. from a pool.
+        """
+        src = Path(src_path)
+        candidates = None
+        if analysis is None:
+            single_pass = self.single_pass
+            if self.prefilter and (single_pass or self.storage_mode == "copy"):
+                # Stream new files in one read; only hash likely duplicates
+                candidates = self.candidates(src)
+                single_pass = not candidates
+            analysis = _analyse_file(
+                src, single_pass, False, self.algorithm, self.formats
+            )
+        file_hash = analysis["hash"]
+        ext = analysis["format"]
+
+        existing = self.lookup(file_hash)
+        if (
+            existing is None
+            and self._other_algorithms
+            and "stored_path" not in analysis
+        ):
+            if candidates is None:
+                candidates = self.candidates(src)
+            existing = self._match_other_algorithms(src, candidates)
+        if existing is not None:
+            self._journal_write(src, existing)
+            return existing
+
+        if "stored_path" in analysis:
+            stored_path = analysis["stored_path"]
+            mode = analysis.get("storage_mode", "stream")
+        else:
+            stored_path, mode = get_blob_store().put(
+                src, file_hash, ext, self.storage_mode
+            )
+
+        metadata = analysis.get("metadata")
+        if metadata is None:
+            metadata = _read_metadata(stored_path, ext)
+        elif "path" in metadata:
+            metadata = {**metadata, "path": stored_path}
+
+        entry = {
+            "hash": file_hash,
+            "stored_path": stored_path,
+            "format": ext,
+            "metadata": metadata,
+            "size": analysis["size"],
+            "algorithm": analysis["algorithm"],
+        }
+        if mode is not None:
+            entry["storage_mode"] = mode
+        self.record(entry, src)
+        return entry
+
+    def record(self, entry: dict[str, object], src: Path | None = None) -> None:
+        # Add an entry to the index unless its hash is already known.
+        if src is not None:
+            self._journal_write(src, entry)
+        existing = self._get(entry["hash"])
+        if existing is not None:
+            existing["stored_path"] = entry["stored_path"]
+            self._changed[existing["hash"]] = existing
+        else:
+            self._add(entry)
+        self._pending += 1
+        if self.checkpoint_every and self._pending >= self.checkpoint_every:
+            self.commit()
+
+    def commit(self) -> None:
+        # Write the index back if anything changed since the last commit.
+        if self._pending:
+            if self.db is not None:
+                self.db.upsert(self._changed.values())
+            else:
+                append_index_log(
+                    [
+                        {
+                            "op": "add" if file_hash in self._added else "update",
+                            "hash": file_hash,
+                            "entry": entry,
+                        }
+                        for file_hash, entry in self._changed.items()
+                    ]
+                )
+            self._changed = {}
+            self._added = set()
+            self._pending = 0
+
+    def close(self) -> None:
+        """
+        Commits and drops the journal. The journal outlives checkpoints so a
+        crash after one can still resume; callers that keep their own
+        progress (the scan manifest) save it before closing.
+        """
+        self.commit()
+        self.clear_journal()
+
+    def clear_journal(self) -> None:
+        # Drop journalled progress; only safe once the index is committed.
+        # Files are unlinked before they are unlocked, so no other session
+        # replays one on its way out.
+        if self._journal is not None:
+            self.journal_path.unlink(missing_ok=True)
+            self._journal.close()
+            self._journal = None
+        for path, f in self._replayed:
+            path.unlink(missing_ok=True)
+            f.close()
+        self._replayed = []
+        self._resumed = {}
+
+
+def store_file(
+    src_path: str | Path, single_pass: bool = False, storage_mode: str | None = None
+) -> dict[str, object]:
+    # Store a file in the library and return its hash as filename.
+    with IngestSession(single_pass=single_pass, storage_mode=storage_mode) as session:
+        return session.add(src_path)
+
+
+def store_files(
+    paths,
+    checkpoint_every: int | None = None,
+    single_pass: bool = False,
+    storage_mode: str | None = None,
 ) -> list[dict[str, object]]:
     """
-    Scans folder for EPUB files and stores them in Library
-    Returns a list of info dicts for each stored file.
+    Stores several files in one ingest session.
+    The index is loaded once and saved at the end (or at checkpoints).
+    """
+    with IngestSession(checkpoint_every, single_pass, storage_mode) as session:
+        return [session.add(path) for path in paths]
+
+
+def iter_import_folder(
+    folder_path: str | Path,
+    recursive: bool = True,
+    checkpoint_every: int | None = None,
+    single_pass: bool = False,
+    workers: int = 1,
+    incremental: bool = True,
+    storage_mode: str | None = None,
+    formats=BOOK_FORMATS,
+):
+    """
+    Scans folder for book files, stores them in Library and yields the info
+    dict of each file as soon as it is stored (or, if unchanged, as soon as
+    it is found). Memory use does not grow with the size of the folder.
+    Every file is sniffed for its format in the same open that hashes it;
+    files whose format is not in `formats` are skipped.
+    With workers > 1, hashing and metadata extraction are fanned out to a
+    process pool while this process stays the single writer of the index.
+    With incremental, files unchanged since the last import (per the scan
+    manifest) are matched to their index entry without being read.
+    The index and manifest are saved when the generator finishes or is closed.
     """
     folder_path = Path(folder_path)
     if not folder_path.exists():
         raise FileNotFoundError(folder_path)
 
-    stored_files = []
+    manifest = ScanManifest() if incremental else None
+    stats = {}
 
-    pattern = "**/*.epub" if recursive else "*.epub"
-    for epub_file in folder_path.glob(pattern):
-        if epub_file.is_file():
-            try:
-                info = store_file(epub_file)
-                stored_files.append(info)
-            except Exception as e:
-                print(f"Failed to store {epub_file}: {e}")
-    return stored_files
+    with IngestSession(
+        checkpoint_every, single_pass, storage_mode, formats=formats
+    ) as session:
+
+        def scanned_files():
+            # Unchanged files come paired with their index entry, so they
+            # pass through the analysis stage in order without being read
+            for book_file, st in iter_files(folder_path, recursive):
+                existing = None
+                if manifest is not None:
+                    known_hash = manifest.lookup(book_file, st)
+                    existing = session.lookup(known_hash) if known_hash else None
+                if existing is None:
+                    existing = session.resumed(book_file)
+                    if existing is not None and manifest is not None:
+                        manifest.update(book_file, st, existing["hash"])
+                if existing is not None:
+                    yield book_file, existing
+                    continue
+                stats[book_file] = st
+                yield book_file
+
+        if workers <= 1:
+            analysed = (
+                (*item, None) if isinstance(item, tuple) else (item, None, None)
+                for item in scanned_files()
+            )
+        else:
+            analysed = iter_analysed(
+                scanned_files(), workers, single_pass, session.algorithm, formats
+            )
+        try:
+            for book_file, analysis, error in analysed:
+                st = stats.pop(book_file, None)
+                if st is None:
+                    yield analysis  # unchanged: the existing index entry
+                    continue
+                try:
+                    if error is not None:
+                        raise error
+                    info = session.add(book_file, analysis)
+                except UnsupportedFormatError:
+                    continue
+                except Exception as e:
+                    print(f"Failed to store {book_file}: {e}")
+                    continue
+                if manifest is not None:
+                    manifest.update(book_file, st, info["hash"])
+                yield info
+        finally:
+            analysed.close()
+            session.commit()
+            if manifest is not None:
+                manifest.save()
+
+
+def import_folder(
+    folder_path: str | Path,
+    recursive: bool = True,
+    checkpoint_every: int | None = None,
+    single_pass: bool = False,
+    workers: int = 1,
+    incremental: bool = True,
+    storage_mode: str | None = None,
+    formats=BOOK_FORMATS,
+) -> list[dict[str, object]]:
+    """
+    Scans folder for book files and stores them in Library
+    See iter_import_folder for the options.
+    Returns a list of info dicts for each stored file.
+    """
+    return list(
+        iter_import_folder(
+            folder_path,
+            recursive,
+            checkpoint_every,
+            single_pass,
+            workers,
+            incremental,
+            storage_mode,
+            formats,
+        )
+    )
+
+
+class _HeadReader(io.RawIOBase):
+    # Replays the bytes already read from the start of a stream, then the
+    # rest; `remaining` counts down from the stream's size
+
+    def __init__(self, head: bytes, f, size: int):
+        self._head = memoryview(head)
+        self._f = f
+        self.remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self._head:
+            n = min(len(b), len(self._head))
+            b[:n] = self._head[:n]
+            self._head = self._head[n:]
+        else:
+            n = self._f.readinto(b)
+        self.remaining -= n
+        return n
+
+
+def _iter_members(archive_path: Path):
+    """
+    Yields (name, size, open_member) for every regular file in a zip or tar
+    archive, in archive order; open_member() opens the file. Opening it is
+    left to the caller so that a member which can't be opened (encrypted,
+    corrupt) is skipped like any other bad member. Tars (compressed or not)
+    are read as a stream, so a member must be opened before the next one is
+    yielded, and corrupt headers are skipped to the next valid one.
+    """
+    # Tar first: a tar ending in an EPUB also passes for a zip
+    if not tarfile.is_tarfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size, partial(zf.open, info)
+        return
+    with tarfile.open(archive_path, "r|*", ignore_zeros=True) as tf:
+        for member in tf:
+            if member.isfile():
+                yield member.name, member.size, partial(tf.extractfile, member)
+
+
+def _analyse_member(
+    f, name: str, size: int, algorithm: str, formats=None
+) -> tuple[dict[str, object], io.BytesIO | None]:
+    """
+    Sniffs an archive member and streams it into the store while hashing it.
+    Members up to ARCHIVE_MEMORY_MAX are read into memory first, which is
+    returned as well so metadata can be read from it.
+    """
+    if size <= ARCHIVE_MEMORY_MAX:
+        data = f.read()
+        fmt = sniff_format(data[:SNIFF_SIZE], lambda o, n: data[o : o + n])
+        source = io.BytesIO(data)
+    else:
+        head = f.read(SNIFF_SIZE)
+        fmt = sniff_format(head)
+        source = None
+    fmt = fmt or Path(name).suffix.lower().lstrip(".")
+    if not fmt:
+        raise UnsupportedFormatError(f"Unknown file format: {name}")
+    if formats is not None and fmt not in formats:
+        raise UnsupportedFormatError(f"Not an accepted format ({fmt}): {name}")
+
+    stream = source if source is not None else _HeadReader(head, f, size)
+    file_hash, stored_path, mode = get_blob_store().put_stream(stream, fmt, algorithm)
+    analysis = {
+        "format": fmt,
+        "size": size,
+        "algorithm": algorithm,
+        "hash": file_hash,
+        "stored_path": stored_path,
+        "storage_mode": mode,
+    }
+    return analysis, source
+
+
+def iter_import_archive(
+    archive_path: str | Path,
+    checkpoint_every: int | None = None,
+    formats=BOOK_FORMATS,
+):
+    """
+    Stores the books in a zip or tar archive (tar.gz, tar.xz, ... too)
+    without extracting it: each member is streamed through hash-while-copy
+    into the blob store, and metadata is read from the member in memory or,
+    for members above ARCHIVE_MEMORY_MAX, from the stored blob.
+    Yields the info dict of each stored file. Members are journalled as
+    <archive>/<member name>, so an interrupted import skips what it stored.
+    """
+    archive_path = Path(archive_path)
+    if not archive_path.exists():
+        raise FileNotFoundError(archive_path)
+
+    with IngestSession(checkpoint_every, formats=formats) as session:
+        try:
+            for name, size, open_member in _iter_members(archive_path):
+                member_path = archive_path / name
+                existing = session.resumed(member_path)
+                if existing is not None:
+                    yield existing
+                    continue
+                try:
+                    with open_member() as f:
+                        analysis, source = _analyse_member(
+                            f, name, size, session.algorithm, formats
+                        )
+                    if source is not None and session.lookup(analysis["hash"]) is None:
+                        analysis["metadata"] = _read_metadata(
+                            analysis["stored_path"], analysis["format"], source
+                        )
+                    info = session.add(member_path, analysis)
+                except UnsupportedFormatError:
+                    continue
+                except Exception as e:
+                    print(f"Failed to store {member_path}: {e}")
+                    continue
+                yield info
+        finally:
+            session.commit()
+
+
+def import_archive(
+    archive_path: str | Path,
+    checkpoint_every: int | None = None,
+    formats=BOOK_FORMATS,
+) -> list[dict[str, object]]:
+    """
+    Stores the books in a zip or tar archive without extracting it.
+    See iter_import_archive. Returns a list of info dicts for each stored file.
+    """
+    return list(iter_import_archive(archive_path, checkpoint_every, formats))
+
+
+def migrate_layout(shard_depth: int | None = None) -> int:
+    """
+    Moves every loose blob to its path in the current shard layout and
+    rewrites stored_path in the index. Blobs are renamed, not re-hashed.
+    Safe to re-run after an interruption. Returns the number of entries moved.
+    """
+    index = load_index()
+    moved = 0
+    for entry in index:
+        if blob_scheme(entry["stored_path"]) is not None:
+            continue  # packed
+        old_path = Path(entry["stored_path"])
+        new_path = blob_path(entry["hash"], entry["format"], shard_depth)
+        if old_path == new_path:
+            continue
+        if old_path.exists():
+            new_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(old_path, new_path)
+            _prune_shards(old_path.parent, DEFAULT_LIBRARY_ROOT / entry["format"])
+        elif not new_path.exists():
+            print(f"Missing blob for {entry['hash']}: {old_path}")
+            continue
+
+        entry["stored_path"] = str(new_path)
+        metadata = entry.get("metadata") or {}
+        if metadata.get("path") == str(old_path):
+            metadata["path"] = str(new_path)
+        moved += 1
+
+    if moved:
+        save_index(index)
+    return moved
+
+
+def migrate_digest(algorithm: str | None = None) -> int:
+    """
+    Re-addresses every blob not yet hashed with `algorithm`.
+    Each blob is hashed once, linked (or copied) to its new address, and the
+    entry is updated with the new hash and algorithm; the old hash is kept as
+    previous_hash. The old blobs are only removed after the index is saved,
+    so an interruption leaves at worst orphans for the reconciler.
+    Returns the number of entries re-addressed.
+    """
+    algorithm = algorithm or DIGEST_ALGORITHM
+    if algorithm not in DIGEST_ALGORITHMS:
+        raise ValueError(f"Unknown digest algorithm: {algorithm}")
+
+    index = load_index()
+    known = {entry["hash"] for entry in index}
+    superseded = []
+    migrated = 0
+    for entry in index:
+        if entry_algorithm(entry) == algorithm:
+            continue
+        old_path = entry["stored_path"]
+        store = resolve(old_path)
+        try:
+            new_hash = store.hash(old_path, algorithm=algorithm)
+        except FileNotFoundError:
+            print(f"Missing blob for {entry['hash']}: {old_path}")
+            continue
+        if new_hash in known:
+            print(f"Skipping {entry['hash']}: {new_hash} is already indexed")
+            continue
+
+        new_path = store.copy(old_path, new_hash, entry["format"])
+        superseded.append(old_path)
+
+        known.add(new_hash)
+        entry["previous_hash"] = entry["hash"]
+        entry["hash"] = new_hash
+        entry["algorithm"] = algorithm
+        entry["stored_path"] = new_path
+        entry.pop("partial_hash", None)
+        metadata = entry.get("metadata") or {}
+        if metadata.get("path") == old_path:
+            metadata["path"] = new_path
+        migrated += 1
+
+    if migrated:
+        save_index(index)
+    for old_path in superseded:
+        delete_blob(old_path)
+    return migrated
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: python -m app.storage migrate-layout [depth]
+    #        python -m app.storage migrate-digest <algorithm>
+    #        python -m app.storage import-archive <archive>
+    #        python -m app.storage compact-index
+    if sys.argv[1:2] == ["migrate-layout"]:
+        depth = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        print(f"Moved {migrate_layout(depth)} blobs")
+    elif sys.argv[1:2] == ["migrate-digest"]:
+        algorithm = sys.argv[2] if len(sys.argv) > 2 else None
+        print(f"Re-addressed {migrate_digest(algorithm)} blobs")
+    elif sys.argv[1:2] == ["import-archive"] and len(sys.argv) > 2:
+        print(f"Stored {len(import_archive(sys.argv[2]))} files")
+    elif sys.argv[1:2] == ["compact-index"]:
+        print(f"Compacted the index log into {compact_index()} entries")
+    else:
+        print("Usage: python -m app.storage migrate-layout [depth]")
+        print("       python -m app.storage migrate-digest <algorithm>")
+        print("       python -m app.storage import-archive <archive>")
+        print("       python -m app.storage compact-index")
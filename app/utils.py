@@ -1,5 +1,7 @@
+import fcntl
 import json
 import os
+import threading
 from pathlib import Path
 
 import dotenv
@@ -7,6 +9,12 @@ import requests
 
 DEFAULT_LIBRARY_ROOT = Path(os.environ.get("LIBRARY_ROOT", "library_files"))
 INDEX_FILE = DEFAULT_LIBRARY_ROOT / "library_index.json"
+# Where the library index lives: "json" (INDEX_FILE) or "sqlite" (see database.py)
+INDEX_BACKEND = os.environ.get("LIBRARY_INDEX_BACKEND", "json")
+# Changes since the last INDEX_FILE snapshot, one JSON record per line
+INDEX_LOG = DEFAULT_LIBRARY_ROOT / "library_index.log"
+# The log is compacted into a new snapshot once it grows past this size
+INDEX_LOG_MAX = int(os.environ.get("LIBRARY_INDEX_LOG_MAX", 16 * 1024 * 1024))
 CACHE_DIR = Path("app/hardcover_cache")
 CACHE_DIR.mkdir(parents=True, exist_ok=True)
 METADATA_FILE = CACHE_DIR / "metadata.json"
@@ -25,16 +33,214 @@ HEADERS = {
 #
 def load_index() -> list[dict]:
     # Load the library index from the JSON file or return an empty list if it doesn't exist
+    # The entries are copies the caller may change (see get_index)
+    if INDEX_BACKEND == "sqlite":
+        from .database import get_db
+
+        return get_db().entries()
+    return [_copy_entry(entry) for entry in get_index()]
+
+
+def _copy_entry(entry: dict) -> dict:
+    # Nested dicts (metadata) are copied too, so callers can edit them in place
+    return {k: dict(v) if isinstance(v, dict) else v for k, v in entry.items()}
+
+
+# The parsed JSON index kept between calls, with the (inode, size, mtime)
+# of the snapshot and log it was read from and how far into the log
+_index_cache = None
+_index_cache_lock = threading.Lock()
+
+
+def _stamp(path: Path) -> tuple | None:
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def get_index() -> list[dict]:
+    """
+    The library index, parsed once per process and shared by every caller,
+    so treat it as read-only (load_index returns a copy to change). Each
+    call stats the snapshot and log to revalidate it: a new snapshot is
+    parsed again, while records appended to the log are replayed onto a
+    copy of the list, leaving lists already handed out unchanged.
+    """
+    global _index_cache
+    if INDEX_BACKEND == "sqlite":
+        from .database import get_db
+
+        return get_db().entries()
+    with _index_cache_lock:
+        cache = _index_cache
+        if cache is None or cache[:2] != (_stamp(INDEX_FILE), _stamp(INDEX_LOG)):
+            cache = _index_cache = _read_index(cache)
+        return cache[3]
+
+
+def _read_index(cache: tuple | None) -> tuple:
+    if not INDEX_LOG.exists():
+        return _stamp(INDEX_FILE), None, 0, _load_snapshot()
+    with INDEX_LOG.open("rb") as log:
+        # Shared lock: compaction can't swap the snapshot and empty the log
+        # between our reads of the two
+        fcntl.flock(log, fcntl.LOCK_SH)
+        snapshot = _stamp(INDEX_FILE)
+        st = os.fstat(log.fileno())
+        log_stamp = st.st_ino, st.st_size, st.st_mtime_ns
+        if (
+            cache is not None
+            and cache[0] == snapshot
+            and cache[1] is not None
+            and cache[1][0] == st.st_ino
+            and st.st_size >= cache[2]
+        ):
+            # Same snapshot, and the log only grew: replay the new records
+            entries, offset = list(cache[3]), cache[2]
+        else:
+            entries, offset = _load_snapshot(), 0
+        log.seek(offset)
+        tail = log.read()
+        end = tail.rfind(b"\n") + 1  # up to the last complete record
+        entries = _replay_log(entries, tail[:end].splitlines(keepends=True))
+        return snapshot, log_stamp, offset + end, entries
+
+
+def _load_snapshot() -> list[dict]:
     if INDEX_FILE.exists():
         with INDEX_FILE.open("r", encoding="utf-8") as f:
             return json.load(f)
     return []
 
 
+def _replay_log(entries: list[dict], log) -> list[dict]:
+    """
+    Applies the records of the index log (lines of it) to a snapshot, in
+    order, changing `entries` but not the entries in it. "add" and
+    "update" set the entry for a hash (appending it if new), "delete" drops
+    it, so replaying records the snapshot already holds changes nothing.
+    """
+    positions = {entry["hash"]: i for i, entry in enumerate(entries)}
+    deleted = False
+    for line in log:
+        if not line.endswith(b"\n"):
+            break  # torn final record from a crash
+        record = json.loads(line)
+        file_hash = record["hash"]
+        i = positions.get(file_hash)
+        if record["op"] == "delete":
+            if i is not None:
+                entries[i] = None
+                del positions[file_hash]
+                deleted = True
+        elif i is None:
+            positions[file_hash] = len(entries)
+            entries.append(record["entry"])
+        else:
+            entries[i] = record["entry"]
+    if deleted:
+        entries = [entry for entry in entries if entry is not None]
+    return entries
+
+
+def _drop_torn_record(fd: int, size: int) -> None:
+    # Cut the log back to its last complete line
+    end = size
+    while end > 0:
+        start = max(0, end - 64 * 1024)
+        newline = os.pread(fd, end - start, start).rfind(b"\n")
+        if newline >= 0:
+            os.ftruncate(fd, start + newline + 1)
+            return
+        end = start
+    os.ftruncate(fd, 0)
+
+
+def append_index_log(records: list[dict]) -> None:
+    """
+    Appends mutation records ({"op": "add" | "update" | "delete", "hash": ...,
+    "entry": ...}) to the index log in one write, instead of rewriting the
+    whole index. Starts a background compaction once the log passes
+    INDEX_LOG_MAX.
+    """
+    if not records:
+        return
+    data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+    INDEX_LOG.parent.mkdir(parents=True, exist_ok=True)
+    with INDEX_LOG.open("a+b") as log:
+        fcntl.flock(log, fcntl.LOCK_EX)
+        fd = log.fileno()
+        size = os.fstat(fd).st_size
+        if size and os.pread(fd, 1, size - 1) != b"\n":
+            _drop_torn_record(fd, size)
+        log.write(data.encode("utf-8"))
+        log.flush()
+        size = os.fstat(fd).st_size
+    if size > INDEX_LOG_MAX:
+        _start_compaction()
+
+
+def _write_snapshot(entries: list[dict]) -> None:
+    # Written to a temp file and renamed, so readers never see half of it
+    INDEX_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = INDEX_FILE.with_suffix(".tmp")
+    with tmp_path.open("w", encoding="utf-8") as f:
+        json.dump(entries, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, INDEX_FILE)
+    # Plus the binary columnar copy that searches can mmap (see snapshot.py)
+    from .snapshot import write_snapshot
+
+    write_snapshot(entries)
+
+
+def compact_index() -> int:
+    # Fold the index log into a new snapshot; returns the entry count
+    global _index_cache
+    INDEX_LOG.parent.mkdir(parents=True, exist_ok=True)
+    with INDEX_LOG.open("ab") as log:
+        fcntl.flock(log, fcntl.LOCK_EX)
+        with INDEX_LOG.open("rb") as records:
+            entries = _replay_log(_load_snapshot(), records)
+        _write_snapshot(entries)
+        os.ftruncate(log.fileno(), 0)
+        stamps = _stamp(INDEX_FILE), _stamp(INDEX_LOG)
+    # The entries are unchanged, so get_index needn't parse them again. Set
+    # after unlocking: get_index holds the cache lock while it waits for ours
+    with _index_cache_lock:
+        _index_cache = *stamps, 0, entries
+    return len(entries)
+
+
+_compaction = None
+_compaction_lock = threading.Lock()
+
+
+def _start_compaction() -> None:
+    # Not a daemon thread: a compaction under way finishes before exit
+    global _compaction
+    with _compaction_lock:
+        if _compaction is None or not _compaction.is_alive():
+            _compaction = threading.Thread(
+                target=compact_index, name="index-compaction"
+            )
+            _compaction.start()
+
+
 def save_index(entries: list[dict]) -> None:
     # Save the library index to the JSON file
-    with INDEX_FILE.open("w", encoding="utf-8") as f:
-        json.dump(entries, f, indent=2, ensure_ascii=False)
+    if INDEX_BACKEND == "sqlite":
+        from .database import get_db
+
+        get_db().replace(entries)
+        return
+    # A full snapshot supersedes the log
+    INDEX_LOG.parent.mkdir(parents=True, exist_ok=True)
+    with INDEX_LOG.open("ab") as log:
+        fcntl.flock(log, fcntl.LOCK_EX)
+        _write_snapshot(entries)
+        os.ftruncate(log.fileno(), 0)
 
 
 #
@@ -73,6 +279,11 @@ def save_to_cache(metadata):
     cache[key] = metadata
     with open(METADATA_FILE, "w") as f:
         json.dump(cache, f, indent=2)
+    if INDEX_BACKEND == "sqlite":
+        # Keep the full-text index of Hardcover fields in step
+        from .database import get_db
+
+        get_db().sync_hardcover(cache)
     print(f"Cached metadata for {metadata.get('title')} (key: {key})")
 
 
@@ -0,0 +1,244 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+
+from .formats import BOOK_FORMATS, UnsupportedFormatError
+from .storage import IngestSession, ScanManifest, iter_files
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal ctypes binding for Linux inotify."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is only available on Linux")
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.paths = {}
+
+    def add_watch(self, path: str | Path, mask: int = WATCH_MASK) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+        self.paths[wd] = Path(path)
+        return wd
+
+    def read_events(self) -> list[tuple[Path | None, int, str]]:
+        # Returns (directory, mask, name) for every queued event.
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            directory = self.paths.get(wd)
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+            events.append((directory, mask, os.fsdecode(name)))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class FolderWatcher:
+    """
+    Long-running ingest for a drop folder. New files are picked up from
+    inotify close-write and move events instead of rescanning the folder.
+    A file is stored once it has seen no events for `debounce` seconds and its
+    size and mtime are stable; index commits are batched by `batch_size` files
+    or `batch_interval` seconds, whichever comes first.
+    Files of any name are considered; only those sniffed as one of the
+    session's `formats` (BOOK_FORMATS by default) are stored.
+    """
+
+    def __init__(
+        self,
+        folder_path: str | Path,
+        recursive: bool = True,
+        debounce: float = 0.5,
+        batch_size: int = 100,
+        batch_interval: float = 1.0,
+        initial_scan: bool = True,
+        on_stored=None,
+        **session_options,
+    ):
+        self.folder_path = Path(folder_path)
+        if not self.folder_path.exists():
+            raise FileNotFoundError(self.folder_path)
+        self.recursive = recursive
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.initial_scan = initial_scan
+        self.on_stored = on_stored
+        self.session_options = {"formats": BOOK_FORMATS, **session_options}
+        self.session = None
+        self.manifest = None
+        self._inotify = None
+        self._pending = {}
+        self._uncommitted = 0
+        self._first_uncommitted = None
+
+    def _watch_tree(self, directory: Path) -> None:
+        # Watch a directory and its subdirectories
+        try:
+            self._inotify.add_watch(directory)
+            subdirs = []
+            if self.recursive:
+                with os.scandir(directory) as it:
+                    subdirs = [e.path for e in it if e.is_dir(follow_symlinks=False)]
+        except OSError as e:
+            print(f"Failed to watch {directory}: {e}")
+            return
+        for subdir in subdirs:
+            self._watch_tree(Path(subdir))
+
+    def _queue(self, path: Path) -> None:
+        self._pending[path] = time.monotonic() + self.debounce
+
+    def _queue_existing(self, directory: Path) -> None:
+        for path, _st in iter_files(directory, self.recursive):
+            self._queue(path)
+
+    def _handle_events(self) -> None:
+        for directory, mask, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped; fall back to one scan of the folder
+                self._queue_existing(self.folder_path)
+                continue
+            if directory is None or not name:
+                continue
+            path = directory / name
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+                    # Files may have landed before the watch was in place
+                    self._queue_existing(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._queue(path)
+
+    def _ingest(self, path: Path) -> None:
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return
+        if st.st_mtime_ns > time.time_ns() - int(self.debounce * 1e9):
+            # Still being written to; check again later
+            self._queue(path)
+            return
+
+        known_hash = self.manifest.lookup(path, st)
+        if known_hash and self.session.lookup(known_hash) is not None:
+            return
+        try:
+            info = self.session.add(path)
+        except UnsupportedFormatError:
+            return
+        except Exception as e:
+            print(f"Failed to store {path}: {e}")
+            return
+        self.manifest.update(path, st, info["hash"])
+        if self._first_uncommitted is None:
+            self._first_uncommitted = time.monotonic()
+        self._uncommitted += 1
+        if self.on_stored is not None:
+            self.on_stored(info)
+
+    def _ingest_due(self) -> None:
+        now = time.monotonic()
+        due = [path for path, when in self._pending.items() if when <= now]
+        for path in due:
+            del self._pending[path]
+            self._ingest(path)
+
+    def commit(self) -> None:
+        self.session.commit()
+        self.manifest.save()
+        self.session.clear_journal()
+        self._uncommitted = 0
+        self._first_uncommitted = None
+
+    def _timeout(self) -> float | None:
+        deadlines = []
+        if self._pending:
+            deadlines.append(min(self._pending.values()))
+        if self._first_uncommitted is not None:
+            deadlines.append(self._first_uncommitted + self.batch_interval)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def run(self, stop: threading.Event | None = None) -> None:
+        """
+        Watches the folder until `stop` is set (or forever). The index is
+        committed on every batch and once more on the way out.
+        """
+        self._inotify = Inotify()
+        self.session = IngestSession(**self.session_options)
+        self.manifest = ScanManifest()
+        try:
+            # Watches go in before the initial scan so no file slips between
+            self._watch_tree(self.folder_path)
+            if self.initial_scan:
+                for path, _st in iter_files(self.folder_path, self.recursive):
+                    self._ingest(path)
+
+            while stop is None or not stop.is_set():
+                timeout = self._timeout()
+                if stop is not None:
+                    # Wake up regularly to notice the stop event
+                    timeout = 0.5 if timeout is None else min(timeout, 0.5)
+                readable, _, _ = select.select([self._inotify.fd], [], [], timeout)
+                if readable:
+                    self._handle_events()
+                self._ingest_due()
+
+                if self._uncommitted >= self.batch_size or (
+                    self._first_uncommitted is not None
+                    and time.monotonic() - self._first_uncommitted
+                    >= self.batch_interval
+                ):
+                    self.commit()
+        finally:
+            self.commit()
+            self._inotify.close()
+
+
+if __name__ == "__main__":
+    # Usage: python -m app.watch <folder>
+    watcher = FolderWatcher(
+        sys.argv[1], on_stored=lambda info: print(f"Stored {info['stored_path']}")
+    )
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass